@@ -2,25 +2,33 @@
 EventHub triggered Azure function, to synchronize knowledge graph in the ADT->CDF direction.
 """
 import os
-import json
 import logging
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from functools import lru_cache
 from typing import List, Tuple, Union
 from datetime import datetime, timezone
 
 import azure.functions as func
+import requests
+from requests.adapters import HTTPAdapter
 from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.digitaltwins.core import DigitalTwinsClient
 from azure.identity import DefaultAzureCredential
-from cognite.client import CogniteClient, ClientConfig
+from cognite.client import CogniteClient, ClientConfig, global_config
 from cognite.client.credentials import OAuthClientCredentials
+from cognite.client.exceptions import CogniteDuplicatedError, CogniteException, CogniteNotFoundError
+import orjson
 
 from cognite.client.data_classes import Asset, AssetUpdate, LabelDefinition, Relationship, RelationshipUpdate, TimeSeries, TimeSeriesUpdate
 
 
 # constant definitions
 ROOT_EXTERNAL_ID = os.environ['ROOT_ASSET_EXTERNAL_ID']
+MAX_WORKERS = int(os.getenv('ADT2CDF_MAX_WORKERS', '16'))   # number of events handled concurrently
 
 class ADT_MODEL_IDS(Enum):
     ASSET = 'dtmi:digitaltwins:cognite:cdf:Asset;1'
@@ -34,95 +42,175 @@ class CLOUD_EVENT_TYPES(Enum):
     RELATIONSHIP_UPDATE = 'Microsoft.DigitalTwins.Relationship.Update'
     RELATIONSHIP_DELETE = 'Microsoft.DigitalTwins.Relationship.Delete'
 
+# (resource kind, operation) parts of each cloud event type, e.g. ('Twin', 'Create')
+CLOUD_EVENT_PARTS = {ct.value: tuple(ct.value.split('.')[2:4]) for ct in CLOUD_EVENT_TYPES}
+
+# once the datapoints of this many timeseries are handed over by the lanes, they are inserted while the rest of the batch is handled
+# (kept well below the EventHub batch size, at most 100 events by default, so that it is reached within a batch)
+DATAPOINTS_FLUSH_SIZE = 32
+
+# ADT queries for another parent/contains relationship of a twin (only the first one is needed), filled in with escape_query_value()
+# the other parent (CT) and the other linked asset (T) are projected as well, so they need not be retrieved separately
+OTHER_PARENT_RELS_QUERY = 'SELECT TOP(1) R, CT FROM DIGITALTWINS T JOIN CT RELATED T.parent R WHERE T.$dtId = \'{src}\' and R.$relationshipId != \'{rid}\''
+OTHER_CONTAIN_RELS_QUERY = 'SELECT TOP(1) R, T FROM DIGITALTWINS T JOIN CT RELATED T.contains R WHERE CT.$dtId = \'{tgt}\' and R.$relationshipId != \'{rid}\''
+
 # class definitions
 class EventRepresentation(object):
+    __slots__ = ('type', 'resource', 'subject', 'body')     # no per-instance __dict__, one object is created per event
     type: str
     resource: str
     subject: str
     body: dict
 
-class MetadataConversion(object):
-    value: str
-    key: str
+    def __init__(self, type: str = '', resource: str = '', subject: str = '', body: dict = None):
+        self.type = type
+        self.resource = resource
+        self.subject = subject
+        self.body = body
+
+class PendingMutations(object):
+    '''
+    CDF mutations collected while handling a batch of events, to be sent with a single request at the end of the batch.
+    Only 'relatesTo' relationships and datapoints are created this way: nothing else in the batch depends on their CDF (internal) ID.
+    Each lane collects its own mutations, and hands them over to the batch when it is done, see hand_over_pending_mutations().
+    '''
+    __slots__ = ('create_relationships', 'insert_datapoints', 'lock')
+    create_relationships: dict
+    insert_datapoints: dict
+    lock: threading.Lock
+
+    def __init__(self):
+        self.create_relationships = {}  # external ID -> Relationship
+        self.insert_datapoints = {}     # timeseries external ID -> list of datapoints, in increasing timestamp order
+        self.lock = threading.Lock()    # lanes are handled concurrently
 
 # disable HTTP request and response logs (headers etc.)
 logging.getLogger('azure.core.pipeline.policies.http_logging_policy').setLevel(logging.WARNING)
 
+# clients are reused across invocations handled by the same worker process (keeping their connection pools and tokens)
+_CDF_CLIENT: CogniteClient = None
+_ADT_CLIENT: DigitalTwinsClient = None
+_ROOT_ASSET: Asset = None
+_CLIENT_LOCK = threading.Lock()     # invocations may run in concurrent threads of the worker process
+_IO_POOL = ThreadPoolExecutor(max_workers=MAX_WORKERS)  # runs independent CDF lookups of a single event in parallel
+
 
 def handle(events: List[func.EventHubEvent]):
     '''
     Parses cloud events from the Event Hub, and handles the event by pushing the appropriate changes to CDF.
     '''
-    #logging.info('Event list length: %s', str(len(events)))
     # update CDF asset hierarchy according to ADT changes
-    cdf_client = get_cdf_client()
-    adt_client = get_adt_client()    
-    rootAsset = cdf_client.assets.retrieve(external_id=ROOT_EXTERNAL_ID)
+    cdf_client = _get_or_create_cdf_client()
+    adt_client = _get_or_create_adt_client()
+    rootAsset = get_root_asset(cdf_client)
     if not rootAsset:
         logging.error('Error: root asset with external id: "%s" was not found in CDF!', ROOT_EXTERNAL_ID)
         return
-    eventIndex = 0
-    for event in events:
-        metadata = event.metadata["PropertiesArray"]
-        if (len(metadata) != len(events)):
-            logging.error('Length of cloud event list (%s) does not match length of metadata (%s)!', len(events), len(metadata))
-            return
-        event_representation = parse_event(event, metadata[eventIndex])
+    list_label_ids.cache_clear()    # label lookups are memoized only within a single invocation
+    if not(events):
+        return 0
+    # the metadata of all the events in the batch is the same list, holding the properties of each event
+    metadata = events[0].metadata["PropertiesArray"]
+    if (len(metadata) != len(events)):
+        logging.error('Length of cloud event list (%s) does not match length of metadata (%s)!', len(events), len(metadata))
+        return
+    # parse all events first, so that the CDF lookups can be batched for the whole event list
+    parsed_events = []
+    for (event, event_properties) in zip(events, metadata):
+        event_representation = parse_event(event, event_properties)
+        # a malformed event is skipped, so that the rest of the batch is still handled and not redelivered
+        if not(event_representation):   # error already logged when parsing
+            continue
         if not(event_representation.type in ['Create', 'Update', 'Delete']):
             logging.error('Error: unknown event type "%s" for event with body %s', event_representation.type, event_representation.body)
-            return
-        logging.info('EVENT INFO: %s %s "%s" at %s.', event_representation.type, event_representation.resource, event_representation.subject, metadata[eventIndex]['cloudEvents:time'])
+            continue
+        parsed_events.append((event_representation, event_properties['cloudEvents:time']))
+
+    cache = prefetch(cdf_client, [er for (er, _) in parsed_events])
+    prefetch_twin_fallbacks(cdf_client, adt_client, [er for (er, _) in parsed_events], cache)
+    cache['pending'] = PendingMutations()
+    cache['query'] = {}     # results of ADT queries, see query_first_rel()
+    # events touching the same resources are handled in order, independent ones concurrently
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(lambda lane: handle_event_lane(cdf_client, adt_client, lane, cache), get_event_lanes(parsed_events)))
+    flush_pending_relationships(cdf_client, cache)
+    flush_pending_datapoints(cdf_client, cache)
+    return len(parsed_events)
+
+
+def handle_event_lane(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, lane: List[Tuple[EventRepresentation, str]], cache: dict = None) -> None:
+    '''
+    Handles the events of a lane one after the other, in the order they were received.
+    An error while handling an event is logged, and does not stop handling the rest of the events.
+    :param CogniteClient cdf_client: The CDF client object
+    :param DigitalTwinsClient adt_client: The ADT client object
+    :param [(EventRepresentation, str)] lane: list of event representations, together with the time of the event
+    :param dict cache: optional cache of prefetched CDF resources
+    '''
+    log_info = logging.getLogger().isEnabledFor(logging.INFO)     # checked once, not for each event
+    batch_cache = cache
+    if ((cache is not None) and ('pending' in cache)):
+        # the lane works on its own copy of the prefetched resources: it may look up resources reached indirectly
+        # (e.g. the other parent of a twin) that another lane is creating or deleting at the same time
+        cache = {k: dict(v) for (k, v) in cache.items() if (k != 'pending')}
+        cache['pending'] = PendingMutations()
+    for (event_representation, event_time) in lane:
+        if (log_info):
+            logging.info('EVENT INFO: %s %s "%s" at %s.', event_representation.type, event_representation.resource, event_representation.subject, event_time)
         
         result = False
-        if (event_representation.resource == 'asset'):
-            result = handle_asset(cdf_client, adt_client, event_representation)
-        elif (event_representation.resource == 'relationship'):
-            result = handle_relationship(cdf_client, adt_client, event_representation)
-        elif (event_representation.resource == 'timeseries'):
-            result = handle_timeseries(cdf_client, adt_client, event_representation)
-        else:
-            logging.error('Unknown cloud event type "%s" for event: %s', event_representation.resource, event_representation.body)
+        try:
+            if (event_representation.resource == 'asset'):
+                result = handle_asset(cdf_client, adt_client, event_representation, cache)
+            elif (event_representation.resource == 'relationship'):
+                result = handle_relationship(cdf_client, adt_client, event_representation, cache)
+            elif (event_representation.resource == 'timeseries'):
+                result = handle_timeseries(cdf_client, adt_client, event_representation, cache)
+            else:
+                logging.error('Unknown cloud event type "%s" for event: %s', event_representation.resource, event_representation.body)
+        except Exception:
+            logging.exception('Unexpected error when processing event for subject "%s"!', event_representation.subject)
 
-        if (result):
+        if (log_info and result):
             logging.info('Event processed sucesfully for subject "%s"!', event_representation.subject)
-        else:
+        elif (log_info):
             logging.info('There was a problem when processing event for subject "%s"! Check log messages above for errors/warnings!', event_representation.subject)
-        
-        eventIndex = eventIndex + 1
-    return eventIndex
+    if (cache is not batch_cache):
+        hand_over_pending_mutations(cdf_client, cache['pending'], batch_cache)
 
 
-def handle_asset(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, event_representation: EventRepresentation) -> bool:
+def handle_asset(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, event_representation: EventRepresentation, cache: dict = None) -> bool:
     '''
     Performs operation on asset.
     :param CogniteClient cdf_client: The CDF client object
     :param DigitalTwinsClient adt_client: The ADT client object
     :param EventRepresentation event_representation: representation of cloud event
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if operation on asset was successfully performed
     '''
     event_body = event_representation.body
-    adt_id = event_representation.subject
-    if (('externalId' in event_body) and (event_body['externalId'])):
-        adt_id = event_body['externalId']
+    adt_id = get_adt_id(event_representation)
 
     if event_representation.type == "Create":
-        return create_asset(cdf_client, adt_id, event_body)
+        return create_asset(cdf_client, adt_id, event_body, cache)
     elif event_representation.type == "Update":
-        return update_asset(cdf_client, adt_client, adt_id, event_body)
+        return update_asset(cdf_client, adt_client, adt_id, event_body, cache)
     elif event_representation.type == "Delete":
-        return delete_asset(cdf_client, adt_id)
+        forget_twin_external_id(event_representation.subject, cache)    # a new twin with the same ID might have other external ID
+        return delete_asset(cdf_client, adt_id, cache)
 
 
-def handle_relationship(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, event_representation: EventRepresentation) -> bool:
+def handle_relationship(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, event_representation: EventRepresentation, cache: dict = None) -> bool:
     '''
     Performs operation on relationship.
     :param CogniteClient cdf_client: The CDF client object
     :param DigitalTwinsClient adt_client: The ADT client object
     :param EventRepresentation event_representation: representation of cloud event
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if operation on relationship was successfully performed
     '''
     if (event_representation.type in ['Create', 'Delete']):   # check in advance if source or target exists for 'Create' or 'Delete'
-        rel_endptspoints = get_rel_endpoints(cdf_client, adt_client, event_representation.body)
+        rel_endptspoints = get_rel_endpoints(cdf_client, adt_client, event_representation.body, cache)
         if not(rel_endptspoints):
             return False
         else:
@@ -130,37 +218,479 @@ def handle_relationship(cdf_client: CogniteClient, adt_client: DigitalTwinsClien
             rel_target = rel_endptspoints[1]
     
     if (event_representation.type == 'Create'):
-        return create_relationship(cdf_client, adt_client, event_representation.body, rel_source, rel_target)
+        return create_relationship(cdf_client, adt_client, event_representation.body, rel_source, rel_target, cache)
     elif (event_representation.type == 'Update'):
-        return update_relationship(cdf_client, event_representation.body, event_representation.subject)
+        return update_relationship(cdf_client, event_representation.body, event_representation.subject, cache)
     elif (event_representation.type == 'Delete'):
-        return delete_relationship(cdf_client, adt_client, event_representation.body, rel_source, rel_target)
+        return delete_relationship(cdf_client, adt_client, event_representation.body, rel_source, rel_target, cache)
 
 
-def handle_timeseries(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, event_representation: EventRepresentation) -> bool:
+def handle_timeseries(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, event_representation: EventRepresentation, cache: dict = None) -> bool:
     '''
     Performs operation on timeseries.
     :param CogniteClient cdf_client: The CDF client object
     :param DigitalTwinsClient adt_client: The ADT client object
     :param EventRepresentation event_representation: representation of cloud event
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if operation on timeseries was successfully performed
     '''
     event_body = event_representation.body
-    adt_id = event_representation.subject
-    if (('externalId' in event_body) and (event_body['externalId'])):
-        adt_id = event_body['externalId']
+    adt_id = get_adt_id(event_representation)
 
     if (event_representation.type == 'Create'):
-        return create_timeseries(cdf_client, adt_id, event_body)
+        return create_timeseries(cdf_client, adt_id, event_body, cache)
     elif (event_representation.type == 'Update'):
-       return update_timeseries(cdf_client, adt_client, adt_id, event_body)
+       return update_timeseries(cdf_client, adt_client, adt_id, event_body, cache)
     elif (event_representation.type == 'Delete'):
-        return delete_timeseries(cdf_client, adt_id)
+        forget_twin_external_id(event_representation.subject, cache)    # a new twin with the same ID might have other external ID
+        return delete_timeseries(cdf_client, adt_id, cache)
 
 
 ###############################################################################
 ############################## utility functions ##############################
 ###############################################################################
+def prefetch(cdf_client: CogniteClient, event_representations: List[EventRepresentation]) -> dict:
+    '''
+    Retrieves all the CDF resources referenced by the given events in advance, with a single request per resource type.
+    :param CogniteClient cdf_client: The CDF client object
+    :param [EventRepresentation] event_representations: representations of the cloud events to be handled
+    :return dict: cache of CDF resources per resource type ('asset', 'timeseries', 'relationship'),
+        mapping external IDs to resources (or None if the resource does not exist in CDF)
+    '''
+    ids = {'asset': set(), 'timeseries': set(), 'relationship': set()}
+    for event_representation in event_representations:
+        resource = event_representation.resource
+        event_body = event_representation.body
+        if (resource in ['asset', 'timeseries']):
+            ids[resource].add(get_adt_id(event_representation))
+        elif (resource == 'relationship'):
+            if (event_representation.type == 'Update'):
+                subject_parts = event_representation.subject.split('/')
+                if (len(subject_parts) == 3):
+                    ids['relationship'].add(subject_parts[2])
+                continue
+            ids['asset'].add(event_body.get('$sourceId'))
+            if (event_body.get('$relationshipName') == 'contains'):
+                ids['timeseries'].add(event_body.get('$targetId'))
+            else:
+                ids['asset'].add(event_body.get('$targetId'))
+            if (event_body.get('$relationshipName') == 'relatesTo'):
+                ids['relationship'].add(event_body.get('$relationshipId'))
+
+    cache = {}
+    for resource in ids:
+        external_ids = [x for x in ids[resource] if x]
+        cache[resource] = dict.fromkeys(external_ids)
+        if (external_ids):
+            for res in retrieve_existing(cdf_client, resource, external_ids):
+                cache[resource][res.external_id] = res
+    return cache
+
+
+def retrieve_existing(cdf_client: CogniteClient, resource: str, external_ids: List[str]) -> list:
+    '''
+    Retrieves the CDF resources with the given external IDs with a single request, skipping the ones that do not exist.
+    The relationships API has no 'ignore_unknown_ids' option: the request is repeated without the external IDs reported as not found.
+    :param CogniteClient cdf_client: The CDF client object
+    :param str resource: type of the resources ('asset', 'timeseries' or 'relationship')
+    :param [str] external_ids: external IDs of the resources
+    :return list: the existing resources
+    '''
+    api = get_resource_api(cdf_client, resource)
+    if (resource != 'relationship'):
+        return api.retrieve_multiple(external_ids=external_ids, ignore_unknown_ids=True)
+    while (external_ids):
+        try:
+            return api.retrieve_multiple(external_ids=external_ids)
+        except CogniteNotFoundError as e:
+            not_found = set(x.get('externalId') for x in e.not_found if isinstance(x, dict))
+            if not(not_found.intersection(external_ids)):
+                raise
+            external_ids = [x for x in external_ids if x not in not_found]
+    return []
+
+
+def prefetch_twin_fallbacks(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, event_representations: List[EventRepresentation], cache: dict) -> None:
+    '''
+    For update events whose twin has no CDF resource under its ADT ID (e.g. the ID contains special characters),
+    looks up the 'externalId' property of the twins concurrently and retrieves the CDF resources under it,
+    with a single request per resource type.
+    The twins are looked up before any event is handled, so they reflect the state of ADT at the start of the batch,
+    not the state right after the preceding events.
+    :param CogniteClient cdf_client: The CDF client object
+    :param DigitalTwinsClient adt_client: The ADT client object
+    :param [EventRepresentation] event_representations: representations of the cloud events to be handled
+    :param dict cache: cache of prefetched CDF resources, updated in place
+    '''
+    created = set(get_adt_id(er) for er in event_representations if (er.type == 'Create'))  # created in this batch, no fallback needed
+    misses = list(dict.fromkeys(get_adt_id(er) for er in event_representations
+        if ((er.type == 'Update') and (er.resource in ['asset', 'timeseries']) and not(cache[er.resource].get(get_adt_id(er))) and (get_adt_id(er) not in created))))
+    cache['twin_external_id'] = {}
+    if not(misses):
+        return
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        cache['twin_external_id'] = dict(zip(misses, executor.map(lambda adt_id: get_twin_external_id(adt_client, adt_id), misses)))
+
+    ids = {'asset': set(), 'timeseries': set()}
+    for er in event_representations:
+        external_id = cache['twin_external_id'].get(get_adt_id(er))
+        if ((er.resource in ids) and external_id and (external_id not in cache[er.resource])):
+            ids[er.resource].add(external_id)
+    for resource in ids:
+        if (ids[resource]):
+            cache[resource].update(dict.fromkeys(ids[resource]))
+            for res in get_resource_api(cdf_client, resource).retrieve_multiple(external_ids=list(ids[resource]), ignore_unknown_ids=True):
+                cache[resource][res.external_id] = res
+
+
+def resolve_asset(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, adt_id: str, cache: dict = None, twin: dict = None) -> Asset:
+    '''
+    Retrieves the CDF asset of a digital twin. The asset is looked up both under the ADT ID and under the "externalId"
+    property of the twin (in case the ID was converted because of special characters), with a single CDF request.
+    :param CogniteClient cdf_client: The CDF client object
+    :param DigitalTwinsClient adt_client: The ADT client object
+    :param str adt_id: The ID of the digital twin
+    :param dict cache: optional cache of prefetched CDF resources
+    :param dict twin: optional digital twin already returned by ADT (e.g. projected by a query), saving its retrieval
+    :return Asset: the CDF asset, or None if it does not exist
+    '''
+    if ((cache is not None) and cache['asset'].get(adt_id)):
+        return cache['asset'][adt_id]
+    twin_external_id = twin.get('externalId') if (twin is not None) else retrieve_cached_twin_external_id(adt_client, adt_id, cache)
+    external_ids = list(dict.fromkeys(x for x in [adt_id, twin_external_id] if x))
+    found = {x: cache['asset'][x] for x in external_ids if x in cache['asset']} if (cache is not None) else {}
+    missing = [x for x in external_ids if x not in found]
+    if (missing):
+        found.update(dict.fromkeys(missing))
+        for res in cdf_client.assets.retrieve_multiple(external_ids=missing, ignore_unknown_ids=True):
+            found[res.external_id] = res
+        for x in missing:
+            set_cached(cache, 'asset', x, found[x])
+    return next((found[x] for x in external_ids if found[x]), None)
+
+
+def get_twin_or_none(adt_client: DigitalTwinsClient, adt_id: str) -> dict:
+    '''
+    Retrieves a digital twin from ADT.
+    :param DigitalTwinsClient adt_client: The ADT client object
+    :param str adt_id: The ID of the twin
+    :return dict: the digital twin, or None if it does not exist
+    '''
+    try:
+        return adt_client.get_digital_twin(adt_id)
+    except ResourceNotFoundError:
+        return None
+
+
+def get_twin_external_id(adt_client: DigitalTwinsClient, adt_id: str) -> str:
+    '''
+    Returns the "externalId" property of a digital twin, i.e. the CDF external ID if it had to be converted for ADT.
+    The value is only remembered for the batch being handled (see retrieve_cached_twin_external_id()):
+    the twin may be deleted and re-created with another "externalId" by events handled by other workers.
+    :param DigitalTwinsClient adt_client: The ADT client object
+    :param str adt_id: The ID of the twin
+    :return str: the external ID, or None if the twin does not exist or has no "externalId" property
+    '''
+    return (get_twin_or_none(adt_client, adt_id) or {}).get('externalId')
+
+
+def retrieve_cached_twin_external_id(adt_client: DigitalTwinsClient, adt_id: str, cache: dict = None) -> str:
+    '''
+    Returns the "externalId" property of a digital twin, looking it up in the cache first (if given).
+    :param DigitalTwinsClient adt_client: The ADT client object
+    :param str adt_id: The ID of the twin
+    :param dict cache: optional cache of prefetched resources
+    :return str: the external ID, or None if the twin does not exist or has no "externalId" property
+    '''
+    if ((cache is not None) and (adt_id in cache.get('twin_external_id', {}))):
+        return cache['twin_external_id'][adt_id]
+    external_id = get_twin_external_id(adt_client, adt_id)
+    if ((cache is not None) and ('twin_external_id' in cache)):
+        cache['twin_external_id'][adt_id] = external_id   # missing twins are remembered too
+    return external_id
+
+
+def forget_twin_external_id(adt_id: str, cache: dict = None) -> None:
+    '''
+    Forgets the known "externalId" property of a digital twin, e.g. because the twin was deleted.
+    :param str adt_id: The ID of the twin
+    :param dict cache: optional cache of prefetched resources
+    '''
+    if ((cache is not None) and ('twin_external_id' in cache)):
+        cache['twin_external_id'].pop(adt_id, None)
+
+
+def get_event_lanes(parsed_events: List[Tuple[EventRepresentation, str]]) -> List[List[Tuple[EventRepresentation, str]]]:
+    '''
+    Splits the events into lanes that can be handled independently: events referring to a common ADT/CDF ID
+    (twin, relationship endpoint or relationship) end up in the same lane, keeping their original order.
+    :param [(EventRepresentation, str)] parsed_events: list of event representations, together with the time of the event
+    :return [[(EventRepresentation, str)]]: list of lanes, each a list of events
+    '''
+    lane_root = list(range(len(parsed_events)))     # union-find forest over the event indices
+    def find_root(i: int) -> int:
+        while (lane_root[i] != i):
+            lane_root[i] = lane_root[lane_root[i]]
+            i = lane_root[i]
+        return i
+
+    first_event_of_id = {}
+    for (i, (event_representation, _)) in enumerate(parsed_events):
+        for x in get_event_ids(event_representation):
+            if (x in first_event_of_id):
+                lane_root[find_root(i)] = find_root(first_event_of_id[x])
+            else:
+                first_event_of_id[x] = i
+    lanes = {}
+    for (i, parsed_event) in enumerate(parsed_events):
+        lanes.setdefault(find_root(i), []).append(parsed_event)
+    return list(lanes.values())
+
+
+def get_event_ids(event_representation: EventRepresentation) -> set:
+    '''
+    Collects all the ADT/CDF IDs the given event refers to.
+    :param EventRepresentation event_representation: representation of cloud event
+    :return set: the IDs
+    '''
+    event_body = event_representation.body
+    ids = {event_representation.subject}
+    if (event_representation.resource in ['asset', 'timeseries']):
+        ids.add(get_adt_id(event_representation))
+    elif (event_representation.resource == 'relationship'):
+        ids.update([event_body.get('$sourceId'), event_body.get('$targetId'), event_body.get('$relationshipId')])
+        subject_parts = event_representation.subject.split('/')
+        if (len(subject_parts) == 3):
+            ids.update([subject_parts[0], subject_parts[2]])
+    ids.discard(None)
+    return ids
+
+
+def get_resource_api(cdf_client: CogniteClient, resource: str):
+    '''
+    Returns the CDF API object corresponding to the given resource type.
+    :param CogniteClient cdf_client: The CDF client object
+    :param str resource: type of the resource ('asset', 'timeseries' or 'relationship')
+    :return: the CDF API object
+    '''
+    if (resource == 'asset'):
+        return cdf_client.assets
+    elif (resource == 'timeseries'):
+        return cdf_client.time_series
+    elif (resource == 'relationship'):
+        return cdf_client.relationships
+    raise ValueError('Unknown CDF resource type ' + resource + '!')
+
+
+def retrieve_cached(cdf_client: CogniteClient, resource: str, external_id: str, cache: dict = None):
+    '''
+    Retrieves a CDF resource by external ID, looking it up in the cache first (if given).
+    :param CogniteClient cdf_client: The CDF client object
+    :param str resource: type of the resource ('asset', 'timeseries' or 'relationship')
+    :param str external_id: external ID of the resource
+    :param dict cache: optional cache of prefetched CDF resources
+    :return Asset|TimeSeries|Relationship: the CDF resource, or None if it does not exist
+    '''
+    if ((cache is not None) and (external_id in cache[resource])):
+        return cache[resource][external_id]
+    res = get_resource_api(cdf_client, resource).retrieve(external_id=external_id)
+    set_cached(cache, resource, external_id, res)
+    return res
+
+
+def set_cached(cache: dict, resource: str, external_id: str, res) -> None:
+    '''
+    Stores the latest state of a CDF resource in the cache (if given), to keep it consistent with CDF.
+    :param dict cache: optional cache of prefetched CDF resources
+    :param str resource: type of the resource ('asset', 'timeseries' or 'relationship')
+    :param str external_id: external ID of the resource
+    :param Asset|TimeSeries|Relationship res: the CDF resource, or None if it was deleted
+    '''
+    if (cache is not None):
+        cache[resource][external_id] = res
+
+
+def create_relationship_deferred(cdf_client: CogniteClient, rel: Relationship, cache: dict = None) -> bool:
+    '''
+    Creates a relationship in CDF, or - if the cache holds pending mutations - adds it to the relationships to be created
+    at the end of the batch. The cache holds the relationship in the meantime, so later events see it as existing.
+    :param CogniteClient cdf_client: The CDF client object
+    :param Relationship rel: the relationship to be created
+    :param dict cache: optional cache of prefetched CDF resources
+    :return bool: True if the relationship is only queued, False if it was created right away
+    '''
+    if ((cache is None) or ('pending' not in cache)):
+        set_cached(cache, 'relationship', rel.external_id, cdf_client.relationships.create(rel))
+        return False
+    with cache['pending'].lock:
+        cache['pending'].create_relationships[rel.external_id] = rel
+        set_cached(cache, 'relationship', rel.external_id, rel)
+    return True
+
+
+def flush_pending_relationships(cdf_client: CogniteClient, cache: dict = None, external_id: str = None) -> None:
+    '''
+    Creates the pending relationships in CDF with a single request.
+    If a relationship creation fails, the relationships are created one by one, so that the rest are still created.
+    :param CogniteClient cdf_client: The CDF client object
+    :param dict cache: optional cache of prefetched CDF resources
+    :param str external_id: if given, the relationships are only created if this relationship is among the pending ones
+    '''
+    if ((cache is None) or ('pending' not in cache)):
+        return
+    pending = cache['pending']
+    with pending.lock:
+        if ((external_id is not None) and (external_id not in pending.create_relationships)):
+            return
+        rels = list(pending.create_relationships.values())
+        pending.create_relationships.clear()
+        if not(rels):
+            return
+        try:
+            created = cdf_client.relationships.create(rels)
+        except CogniteException:
+            logging.exception('Cannot create %s CDF relationships at once, creating them one by one!', len(rels))
+            created = []
+            for rel in rels:
+                cache['relationship'].pop(rel.external_id, None)   # state in CDF is unknown, retrieve again if needed
+                try:
+                    created.append(cdf_client.relationships.create(rel))
+                except CogniteException:
+                    logging.exception('Cannot create CDF relationship with external ID "%s"!', rel.external_id)
+        for res in created:
+            set_cached(cache, 'relationship', res.external_id, res)
+            logging.info('CDF relationship "%s" was created!', res.external_id)
+
+
+def insert_datapoint_deferred(cdf_client: CogniteClient, external_id: str, datapoint: dict, cache: dict = None) -> bool:
+    '''
+    Inserts a datapoint into a CDF timeseries, or - if the cache holds pending mutations - adds it to the datapoints
+    to be inserted at the end of the batch.
+    :param CogniteClient cdf_client: The CDF client object
+    :param str external_id: external ID of the timeseries
+    :param dict datapoint: the datapoint, with 'timestamp' (ms) and 'value' keys
+    :param dict cache: optional cache of prefetched CDF resources
+    :return bool: True if the datapoint is only queued, False if it was inserted right away
+    '''
+    if ((cache is None) or ('pending' not in cache)):
+        cdf_client.datapoints.insert([datapoint], external_id=external_id)
+        return False
+    with cache['pending'].lock:
+        cache['pending'].insert_datapoints.setdefault(external_id, []).append(datapoint)
+    return True
+
+
+def get_pending_latest_datapoint(external_id: str, cache: dict = None) -> dict:
+    '''
+    Returns the latest datapoint waiting to be inserted into a CDF timeseries.
+    :param str external_id: external ID of the timeseries
+    :param dict cache: optional cache of prefetched CDF resources
+    :return dict: the datapoint, or None if there is no pending datapoint for the timeseries
+    '''
+    if ((cache is None) or ('pending' not in cache)):
+        return None
+    with cache['pending'].lock:
+        datapoints = cache['pending'].insert_datapoints.get(external_id)
+        return datapoints[-1] if (datapoints) else None
+
+
+def hand_over_pending_mutations(cdf_client: CogniteClient, lane_pending: PendingMutations, cache: dict) -> None:
+    '''
+    Hands the mutations collected while handling a lane over to the batch. No other lane refers to them, so once the
+    datapoints of DATAPOINTS_FLUSH_SIZE timeseries are collected they are inserted right away, overlapping with the
+    lanes still being handled and keeping the number of buffered datapoints bounded.
+    :param CogniteClient cdf_client: The CDF client object
+    :param PendingMutations lane_pending: the mutations collected by the lane
+    :param dict cache: cache of prefetched CDF resources, holding the pending mutations of the batch
+    '''
+    pending = cache['pending']
+    with pending.lock:
+        pending.create_relationships.update(lane_pending.create_relationships)
+        for (external_id, datapoints) in lane_pending.insert_datapoints.items():
+            pending.insert_datapoints.setdefault(external_id, []).extend(datapoints)
+        is_full = (len(pending.insert_datapoints) >= DATAPOINTS_FLUSH_SIZE)
+    if (is_full):
+        flush_pending_datapoints(cdf_client, cache)
+
+
+def flush_pending_datapoints(cdf_client: CogniteClient, cache: dict = None) -> None:
+    '''
+    Inserts the pending datapoints into CDF with a single request (for all timeseries).
+    If the request fails, the datapoints are inserted per timeseries, so that the rest are still inserted.
+    :param CogniteClient cdf_client: The CDF client object
+    :param dict cache: optional cache of prefetched CDF resources
+    '''
+    if ((cache is None) or ('pending' not in cache)):
+        return
+    pending = cache['pending']
+    with pending.lock:
+        items = [{'external_id': x, 'datapoints': dps} for (x, dps) in pending.insert_datapoints.items()]
+        pending.insert_datapoints.clear()
+    if not(items):
+        return
+    inserted = items
+    try:
+        cdf_client.datapoints.insert_multiple(items)
+    except CogniteException:
+        logging.exception('Cannot insert datapoints into %s CDF timeseries at once, inserting them one by one!', len(items))
+        inserted = []
+        for item in items:
+            try:
+                cdf_client.datapoints.insert(item['datapoints'], external_id=item['external_id'])
+                inserted.append(item)
+            except CogniteException:
+                logging.exception('Cannot insert datapoints into CDF timeseries with external ID "%s"!', item['external_id'])
+    for item in inserted:
+        logging.info('New datapoints %s added to timeseries "%s"!', item['datapoints'], item['external_id'])
+
+
+@lru_cache(maxsize=256)
+def list_label_ids(cdf_client: CogniteClient, external_id_prefix: str) -> Tuple[str, ...]:
+    '''
+    Lists the external IDs of the CDF labels starting with the given prefix.
+    The results are memoized, so repeated labels in the same batch of events are looked up only once.
+    :param CogniteClient cdf_client: The CDF client object
+    :param str external_id_prefix: prefix of the label external IDs
+    :return (str): tuple of label external IDs
+    '''
+    return tuple(x.external_id for x in cdf_client.labels.list(external_id_prefix=external_id_prefix))
+
+
+def query_first_rel(adt_client: DigitalTwinsClient, query: str, cache: dict = None) -> dict:
+    '''
+    Runs an ADT relationship query and returns its first result. The queries are limited to a single result with TOP(1),
+    and the result is memoized in the cache (if given), so the same query is run only once per batch of events.
+    :param DigitalTwinsClient adt_client: The ADT client object
+    :param str query: the ADT query
+    :param dict cache: optional cache of prefetched resources
+    :return dict: the first result of the query, or None if there are no results
+    '''
+    if ((cache is not None) and ('query' in cache) and (query in cache['query'])):
+        return cache['query'][query]
+    first = next(adt_client.query_twins(query), None)
+    if ((cache is not None) and ('query' in cache)):
+        cache['query'][query] = first
+    return first
+
+
+def escape_query_value(value: str) -> str:
+    '''
+    Escapes a value to be used inside a single-quoted string literal of an ADT query.
+    :param str value: the value to escape
+    :return str: the escaped value
+    '''
+    return value.replace('\\', '\\\\').replace('\'', '\\\'')
+
+
+def get_adt_id(event_representation: EventRepresentation) -> str:
+    '''
+    Determines the ID of the resource from ADT: the "externalId" property if set, otherwise the cloud event subject.
+    :param EventRepresentation event_representation: representation of cloud event
+    :return str: the ID of the resource
+    '''
+    return event_representation.body.get('externalId') or event_representation.subject
+
+
 def parse_event(event: func.EventHubEvent, event_properties: dict) -> EventRepresentation:
     '''
     Parses the cloud event from the EventHub and converts it to 'EventRepresentation' for easier usage.
@@ -168,85 +698,80 @@ def parse_event(event: func.EventHubEvent, event_properties: dict) -> EventRepre
     :param dict event_properties: additional information on event from metadata
     :return EventRepresentation: The polished representation of the cloud event
     '''
+    body = event.get_body()     # orjson parses the bytes directly, decoding is only needed for logging errors
     try:
-        try:
-            cloud_event_type = CLOUD_EVENT_TYPES(event_properties["cloudEvents:type"])
-            event_representation = EventRepresentation()
-            event_representation.body = json.loads(event.get_body().decode('utf-8'))
-            event_representation.subject = event_properties['cloudEvents:subject']
-            cloud_event_parts = cloud_event_type.value.split('.')
-            if (len(cloud_event_parts) >= 4 and cloud_event_parts[3] in ['Create', 'Update', 'Delete']):
-                event_representation.type = cloud_event_parts[3]
-            if (cloud_event_parts[2] == 'Twin'):
-                if (cloud_event_parts[3] == 'Create' or cloud_event_parts[3] == 'Delete'):
-                    model = event_representation.body['$metadata']['$model']
-                elif (cloud_event_parts[3] == 'Update'):
-                    model = event_representation.body['modelId']
-                else:
-                    model = None
-                if (model == ADT_MODEL_IDS.ASSET.value):
-                    event_representation.resource = 'asset'
-                elif (model == ADT_MODEL_IDS.TIMESERIES.value):
-                    event_representation.resource = 'timeseries'
-            elif (cloud_event_parts[2] == 'Relationship'):
-                event_representation.resource = 'relationship'
-            return event_representation
-        except ValueError:
+        cloud_event_parts = CLOUD_EVENT_PARTS.get(event_properties["cloudEvents:type"])
+        if not(cloud_event_parts):
             logging.error('Cloud event type "%s" is not handled by the current solution!', event_properties["cloudEvents:type"])
-
+            return None
+        (event_kind, event_op) = cloud_event_parts
+        event_body = orjson.loads(body)
+        resource = ''
+        if (event_kind == 'Twin'):
+            if (event_op == 'Create' or event_op == 'Delete'):
+                model = event_body['$metadata']['$model']
+            elif (event_op == 'Update'):
+                model = event_body['modelId']
+            else:
+                model = None
+            if (model == ADT_MODEL_IDS.ASSET.value):
+                resource = 'asset'
+            elif (model == ADT_MODEL_IDS.TIMESERIES.value):
+                resource = 'timeseries'
+        elif (event_kind == 'Relationship'):
+            resource = 'relationship'
+        return EventRepresentation(type=event_op, resource=resource, subject=event_properties['cloudEvents:subject'], body=event_body)
+    except orjson.JSONDecodeError:
+        logging.error('Cannot parse the body of cloud event: %s with metadata: %s!', body.decode('utf-8', errors='replace'), event_properties)
     except KeyError:
-        logging.error('Key error when parsing cloud event with body: %s and metadata: %s!', event.get_body().decode('utf-8'), event_properties)
+        logging.error('Key error when parsing cloud event with body: %s and metadata: %s!', body.decode('utf-8', errors='replace'), event_properties)
 
 
-def create_asset(cdf_client: CogniteClient, adt_id: str, event_body: dict) -> bool:
+def create_asset(cdf_client: CogniteClient, adt_id: str, event_body: dict, cache: dict = None) -> bool:
     '''
     Creates a new asset in CDF, if it does not exist yet.
     :param CogniteClient cdf_client: The CDF client object
     :param str adt_id: The ID of the asset from ADT
     :param dict event_body: body of cloud event holding data about the new asset
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if asset was successfully created
     '''
-    if not has_asset_in_CDF_by_external_id(cdf_client, adt_id):
-        # create the new asset
-        new_asset = Asset(external_id=adt_id, parent_external_id=ROOT_EXTERNAL_ID)
-        if ('displayName' in event_body):
-            new_asset.name = event_body['displayName']
-        else:
-            new_asset.name = event_body.get('$dtId')    # name is mandatory in CDF
-        if ('description' in event_body):
-            new_asset.description = event_body['description']
-        if ('values' in event_body['tags']):
-            new_asset.metadata = event_body['tags']['values']
-        cdf_client.assets.create(new_asset)
-    else:
+    new_asset = Asset(external_id=adt_id, parent_external_id=ROOT_EXTERNAL_ID,
+        name=event_body.get('displayName', event_body.get('$dtId')),     # name is mandatory in CDF
+        description=event_body.get('description'),
+        metadata=event_body['tags'].get('values'))
+    try:    # no existence check in advance, CDF rejects duplicates anyway
+        set_cached(cache, 'asset', adt_id, cdf_client.assets.create(new_asset))
+    except CogniteDuplicatedError:
         logging.warning('CDF asset with external ID "%s" already exists!', adt_id)
         return False
     return True
 
 
-def update_asset(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, adt_id: str, event_body: dict) -> bool:
+def update_asset(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, adt_id: str, event_body: dict, cache: dict = None) -> bool:
     '''
     Updates an existing asset in CDF.
     :param CogniteClient cdf_client: The CDF client object
     :param DigitalTwinsClient adt_client: The ADT client object
     :param str adt_id: The ID of the asset from ADT
     :param dict event_body: body of cloud event holding data about the asset
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if asset was successfully updated
     '''
-    asset_to_update = cdf_client.assets.retrieve(external_id=adt_id)
+    asset_to_update = retrieve_cached(cdf_client, 'asset', adt_id, cache)
     if not(asset_to_update):  # maybe ID contains special characters
-        dt = adt_client.get_digital_twin(adt_id)
-        if ('externalId' not in dt):
+        external_id = retrieve_cached_twin_external_id(adt_client, adt_id, cache)
+        if not(external_id):
             logging.error('Cannot perform update! CDF asset with external ID "%s" does not exist!', adt_id)
             return False
-        asset_to_update = cdf_client.assets.retrieve(external_id=dt['externalId'])
+        asset_to_update = retrieve_cached(cdf_client, 'asset', external_id, cache)
         if not(asset_to_update):
-            logging.error('Cannot perform update! CDF asset with external ID "%s" does not exist!', dt['externalId'])
+            logging.error('Cannot perform update! CDF asset with external ID "%s" does not exist!', external_id)
             return False
     try:
-        has_change, asset_to_update = fetch_changes_to_CDF_record(cdf_client, asset_to_update, event_body)
+        has_change, asset_to_update = fetch_changes_to_CDF_record(cdf_client, asset_to_update, event_body, cache)
         if has_change:
-            cdf_client.assets.update(asset_to_update)
+            set_cached(cache, 'asset', asset_to_update.external_id, cdf_client.assets.update(asset_to_update))
         else:
             logging.warning('Nothing to update! The asset "%s" is already up to date!', asset_to_update.external_id)
         return True
@@ -255,99 +780,155 @@ def update_asset(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, adt_
         return False
 
 
-def delete_asset(cdf_client: CogniteClient, adt_id: str) -> bool:
+def delete_asset(cdf_client: CogniteClient, adt_id: str, cache: dict = None) -> bool:
     '''
     Deletes an existing asset from CDF.
     :param CogniteClient cdf_client: The CDF client object
     :param str adt_id: The ID of the asset from ADT
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if asset was successfully deleted
     '''
-    if has_asset_in_CDF_by_external_id(cdf_client, adt_id):
-        cdf_client.assets.delete(external_id=adt_id)
-    else:
-        logging.warning('CDF asset with external ID "%s" was not found!', adt_id)
+    cdf_client.assets.delete(external_id=adt_id, ignore_unknown_ids=True)
+    set_cached(cache, 'asset', adt_id, None)
     return True
 
 
-def has_asset_in_CDF_by_external_id(cdf_client: CogniteClient, adt_id: str) -> bool:
+def has_asset_in_CDF_by_external_id(cdf_client: CogniteClient, adt_id: str, cache: dict = None) -> bool:
     '''
     Check if asset exists in CDF using cloud event subject as an external ID
     :param CogniteClient cdf_client: The CDF client object
     :param str adt_id: The ID of the asset from ADT
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if asset exists
     '''
-    asset = cdf_client.assets.retrieve(external_id=adt_id)
-    # logging.info('asset: %s %s', asset, (asset is not None))
+    asset = retrieve_cached(cdf_client, 'asset', adt_id, cache)
     return (asset is not None)
 
 
-def fetch_changes_to_CDF_record(cdf_client: CogniteClient, record_to_update: Union[Asset, TimeSeries], event_body: dict):
+def fetch_changes_to_CDF_record(cdf_client: CogniteClient, record_to_update: Union[Asset, TimeSeries], event_body: dict, cache: dict = None):
     '''
     Updates the given CDF resource in memory, according to changes originating from the event body.
     :param CogniteClient cdf_client: The CDF client object
     :param Asset|TimeSeries record_to_update: The current CDF resource to be updated
     :param dict event_body: body of cloud event holding data about the new resource
+    :param dict cache: optional cache of prefetched CDF resources
     :return (bool, Asset|TimeSeries): True if changes were made, and the updated resource
     '''
     has_change = False
     converted_metadata = convert_metadata(record_to_update.metadata)
     for action in event_body['patch']:
-        # check if the was updated before to close the event loop
-        if action['path']=='/displayName':
-            if action['op']=='remove':
-                continue
-            else:
-                if record_to_update.name!=action['value'] :
-                    record_to_update.name = action['value']
-                    has_change = True
-        elif (action['path'] == '/description'):
-            if (action['op'] == 'remove'):
-                if (record_to_update.description):
-                    record_to_update.description = ''
-                    has_change = True
-            else:
-                if (record_to_update.description != action['value']):
-                    record_to_update.description = action['value']
-                    has_change = True
-        elif action['path']=='/externalId':
-            # the external_id is immutable in CDF
-            if action['op']=='add':
-                # check if the new external ID exists in CDF
-                if not has_asset_in_CDF_by_external_id(cdf_client, adt_id=action['value']):
-                    logging.error('Inconsistent hierarchy warning. The external ID "%s" already exists in CDF!', action['value'])
-            else:
-                logging.error('Invalid operation: DO NOT modify the "externalId" property in ADT!')
-            continue
-        elif action['path']=='/id':
-            if action['op']!='add':
-                logging.error('Invalid operation: DO NOT modify the "id" property in ADT!')
-            continue
-        elif (action['path'] == '/tags/values'):
-            if (action['op'] == 'add'):
-                if not(converted_metadata):
-                    record_to_update.metadata = action['value']
-                    has_change = True
-                else:
-                    logging.warning('Trying to add metadata, but it already exists in CDF!')
-            if (action['op'] == 'remove'):
-                if (converted_metadata):
-                    record_to_update.metadata = {}
-                    has_change = True
-        else:
-            # fetch metadata
-            if action['path'].startswith('/tags/values/'):
-                path = action['path'].replace('/tags/values/', '')
-                if action['op']=='replace':
-                    has_change, record_to_update = check_value_change_and_update_record(has_change, record_to_update, converted_metadata, path, action['value'])
+        path = action['path']
+        apply_patch = PATCH_HANDLERS.get(path)
+        if (apply_patch):
+            has_change |= apply_patch(cdf_client, record_to_update, action, converted_metadata, cache)
+        elif path.startswith(METADATA_PATH_PREFIX):
+            has_change |= apply_metadata_key_patch(cdf_client, record_to_update, action, converted_metadata, cache)
+
+    return has_change, record_to_update
 
-                if action['op']=='add':
-                    has_change, record_to_update = check_value_change_and_update_record(has_change, record_to_update, converted_metadata, path, action['value'])
 
-                if action['op']=='remove' and path in converted_metadata:
-                    has_change = True
-                    del record_to_update.metadata[converted_metadata[path].key]
+def apply_display_name_patch(cdf_client: CogniteClient, record_to_update: Union[Asset, TimeSeries], action: dict,
+    converted_metadata: dict, cache: dict = None) -> bool:
+    '''
+    Applies a "/displayName" patch operation to the CDF resource in memory.
+    The parameters are the same for all patch handlers, see "PATCH_HANDLERS".
+    :param CogniteClient cdf_client: The CDF client object
+    :param Asset|TimeSeries record_to_update: The current CDF resource to be updated
+    :param dict action: the JSON patch operation
+    :param dict converted_metadata: CDF metadata converted to be able to handle special keys as well
+    :param dict cache: optional cache of prefetched CDF resources
+    :return bool: True if changes were made
+    '''
+    if (action['op'] != 'remove') and (record_to_update.name != action['value']):
+        record_to_update.name = action['value']
+        return True
+    return False
 
-    return has_change, record_to_update
+
+def apply_description_patch(cdf_client: CogniteClient, record_to_update: Union[Asset, TimeSeries], action: dict,
+    converted_metadata: dict, cache: dict = None) -> bool:
+    '''
+    Applies a "/description" patch operation to the CDF resource in memory.
+    '''
+    if (action['op'] == 'remove'):
+        if (record_to_update.description):
+            record_to_update.description = ''
+            return True
+    elif (record_to_update.description != action['value']):
+        record_to_update.description = action['value']
+        return True
+    return False
+
+
+def apply_external_id_patch(cdf_client: CogniteClient, record_to_update: Union[Asset, TimeSeries], action: dict,
+    converted_metadata: dict, cache: dict = None) -> bool:
+    '''
+    Checks an "/externalId" patch operation: the external ID is immutable in CDF, so nothing is changed.
+    '''
+    if (action['op'] == 'add'):
+        # check if the new external ID exists in CDF
+        if not has_asset_in_CDF_by_external_id(cdf_client, adt_id=action['value'], cache=cache):
+            logging.error('Inconsistent hierarchy warning. The external ID "%s" already exists in CDF!', action['value'])
+    else:
+        logging.error('Invalid operation: DO NOT modify the "externalId" property in ADT!')
+    return False
+
+
+def apply_id_patch(cdf_client: CogniteClient, record_to_update: Union[Asset, TimeSeries], action: dict,
+    converted_metadata: dict, cache: dict = None) -> bool:
+    '''
+    Checks an "/id" patch operation: the internal ID cannot be changed in CDF, so nothing is changed.
+    '''
+    if (action['op'] != 'add'):
+        logging.error('Invalid operation: DO NOT modify the "id" property in ADT!')
+    return False
+
+
+def apply_metadata_patch(cdf_client: CogniteClient, record_to_update: Union[Asset, TimeSeries], action: dict,
+    converted_metadata: dict, cache: dict = None) -> bool:
+    '''
+    Applies a "/tags/values" patch operation (i.e. on the whole metadata) to the CDF resource in memory.
+    '''
+    if (action['op'] == 'add'):
+        if not(converted_metadata):
+            record_to_update.metadata = action['value']
+            converted_metadata.update(convert_metadata(record_to_update.metadata))
+            return True
+        logging.warning('Trying to add metadata, but it already exists in CDF!')
+    elif (action['op'] == 'remove'):
+        if (converted_metadata):
+            record_to_update.metadata = {}
+            converted_metadata.clear()
+            return True
+    return False
+
+
+def apply_metadata_key_patch(cdf_client: CogniteClient, record_to_update: Union[Asset, TimeSeries], action: dict,
+    converted_metadata: dict, cache: dict = None) -> bool:
+    '''
+    Applies a "/tags/values/<key>" patch operation (i.e. on a single metadata key) to the CDF resource in memory.
+    '''
+    path = action['path'][len(METADATA_PATH_PREFIX):]
+    if (action['op'] in ['replace', 'add']):
+        has_change, _ = check_value_change_and_update_record(False, record_to_update, converted_metadata, path, action['value'])
+        return has_change
+    if (action['op'] == 'remove'):
+        entry = converted_metadata.pop(path, None)
+        if (entry is not None):
+            del record_to_update.metadata[entry[0]]
+            return True
+    return False
+
+
+# handlers of JSON patch operations by path, the metadata keys ("/tags/values/<key>") are handled separately
+METADATA_PATH_PREFIX = '/tags/values/'
+PATCH_HANDLERS = {
+    '/displayName': apply_display_name_patch,
+    '/description': apply_description_patch,
+    '/externalId': apply_external_id_patch,
+    '/id': apply_id_patch,
+    '/tags/values': apply_metadata_patch,
+}
 
 
 def check_value_change_and_update_record(has_change: bool, record_to_update: Union[Asset, TimeSeries], 
@@ -361,19 +942,17 @@ def check_value_change_and_update_record(has_change: bool, record_to_update: Uni
     :param str metadata_value: Metadata value to check if it needs to be updated
     :return (bool, Asset|TimeSeries): True if changes were made, and the updated resource
     '''
-    if metadata_key in converted_metadata:
-        if converted_metadata[metadata_key].value != metadata_value:
-            has_change = True
-            record_to_update.metadata[converted_metadata[metadata_key].key] = metadata_value
-    else:
-        # add metadata if not found in CDF
+    # metadata is added with the same key if not found in CDF
+    (real_key, current_value) = converted_metadata.get(metadata_key, (metadata_key, None))
+    if (current_value != metadata_value):
         has_change = True
-        record_to_update.metadata[metadata_key] = metadata_value
+        record_to_update.metadata[real_key] = metadata_value
+        converted_metadata[metadata_key] = (real_key, metadata_value)   # keep the converted view up to date
 
     return has_change, record_to_update
 
 
-def get_rel_endpoints(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, rel: dict) -> Union[Tuple[Asset, Union[Asset, TimeSeries]], None]:
+def get_rel_endpoints(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, rel: dict, cache: dict = None) -> Union[Tuple[Asset, Union[Asset, TimeSeries]], None]:
     '''
     Retrieves the CDF source and target resource of an ADT relationship.
     The external ID of the relationship endpoints might have been converted (because of special characters),
@@ -382,65 +961,57 @@ def get_rel_endpoints(cdf_client: CogniteClient, adt_client: DigitalTwinsClient,
     :param CogniteClient cdf_client: The CDF client object
     :param DigitalTwinsClient adt_client: The ADT client object
     :param dict rel: The relationship structure from ADT
+    :param dict cache: optional cache of prefetched CDF resources
     :return Tuple: tuple of source and target resources
     '''
     # source is always Asset (at least in the current solution)
-    source_asset = cdf_client.assets.retrieve(external_id=rel['$sourceId'])
+    source_asset = retrieve_cached(cdf_client, 'asset', rel['$sourceId'], cache)
     # target can be Timeseries or Asset
     if (rel['$relationshipName'] == 'contains'):
-        target_res = cdf_client.time_series.retrieve(external_id=rel['$targetId'])
+        target_res = retrieve_cached(cdf_client, 'timeseries', rel['$targetId'], cache)
     else:
-        target_res = cdf_client.assets.retrieve(external_id=rel['$targetId'])
+        target_res = retrieve_cached(cdf_client, 'asset', rel['$targetId'], cache)
     if ((source_asset) and (target_res)):
         return (source_asset, target_res)
 
     if not(source_asset):
         # maybe external ID has special characters, check original external ID too
-        try:
-            source_dt = adt_client.get_digital_twin(digital_twin_id=rel['$sourceId'])
-        except ResourceNotFoundError:
-            source_dt = {}
-        if ('externalId' not in source_dt):
+        source_external_id = retrieve_cached_twin_external_id(adt_client, rel['$sourceId'], cache)
+        if not(source_external_id):
             logging.warning('The asset with digital twin ID "%s" does not exist in ADT anymore!', rel['$sourceId'])
             return None
-        source_asset = cdf_client.assets.retrieve(external_id=source_dt['externalId'])
+        source_asset = retrieve_cached(cdf_client, 'asset', source_external_id, cache)
         if not(source_asset):
-            logging.warning('The asset with external ID "%s" does not exist in CDF!', source_dt['externalId'])
+            logging.warning('The asset with external ID "%s" does not exist in CDF!', source_external_id)
             return None
 
     if (rel['$relationshipName'] == 'contains'):
         if not(target_res):
             # maybe external ID has special characters
-            try:
-                target_dt = adt_client.get_digital_twin(digital_twin_id=rel['$targetId'])
-            except ResourceNotFoundError:
-                target_dt = {}
-            if ('externalId' not in target_dt):
+            target_external_id = retrieve_cached_twin_external_id(adt_client, rel['$targetId'], cache)
+            if not(target_external_id):
                 logging.warning('The timeseries with digital twin ID "%s" does not exist in ADT anymore!', rel['$targetId'])
                 return None
-            target_res = cdf_client.time_series.retrieve(external_id=target_dt['externalId'])
+            target_res = retrieve_cached(cdf_client, 'timeseries', target_external_id, cache)
             if not(target_res):
-                logging.warning('The timeseries with external ID "%s" does not exist in CDF!', target_dt['externalId'])
+                logging.warning('The timeseries with external ID "%s" does not exist in CDF!', target_external_id)
                 return None
     else:
         if not(target_res):
             # maybe external ID has special characters
-            try:
-                target_dt = adt_client.get_digital_twin(digital_twin_id=rel['$targetId'])
-            except ResourceNotFoundError:
-                target_dt = {}
-            if ('externalId' not in target_dt):
+            target_external_id = retrieve_cached_twin_external_id(adt_client, rel['$targetId'], cache)
+            if not(target_external_id):
                 logging.error('The timeseries with external ID "%s" does not exist in ADT anymore!', rel['$targetId'])
                 return None
-            target_res = cdf_client.assets.retrieve(external_id=target_dt['externalId'])
+            target_res = retrieve_cached(cdf_client, 'asset', target_external_id, cache)
             if not(target_res):
-                logging.error('The asset with external ID "%s" does not exist in CDF!', target_dt['externalId'])
+                logging.error('The asset with external ID "%s" does not exist in CDF!', target_external_id)
                 return None
     return (source_asset, target_res)
 
 
 def create_relationship(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, event_body: dict,
-    rel_source: Asset, rel_target: Union[Asset, TimeSeries]) -> bool:
+    rel_source: Asset, rel_target: Union[Asset, TimeSeries], cache: dict = None) -> bool:
     '''
     Creates new (implicit/explicit) relationship in CDF.
     :param CogniteClient cdf_client: The CDF client object
@@ -448,77 +1019,81 @@ def create_relationship(cdf_client: CogniteClient, adt_client: DigitalTwinsClien
     :param dict event_body: body of the cloud event
     :param Asset rel_source: source asset of the relationship to be created
     :param Asset|TimeSeries rel_target: target asset/timeseries of the relationship to be created
-    :return bool: True if relationship was successfully created
+    :param dict cache: optional cache of prefetched CDF resources
+    :return bool: True if relationship was successfully created, or queued to be created at the end of the batch
     '''
     ############################## parent relationship ##############################
     if (event_body['$relationshipName'] == 'parent'):  # parent relationship between assets
         # get other parent relationships and DO NOT change parent if this is another parent relationship
-        parent_rels = adt_client.query_twins('SELECT R FROM DIGITALTWINS T JOIN CT RELATED T.parent R ' +
-            'WHERE T.$dtId = \'' + event_body['$sourceId'] + '\'' +
-            ' and R.$relationshipId != \'' + event_body['$relationshipId'] + '\'')
-        if (next(parent_rels, None)):
+        other_parent_rel = query_first_rel(adt_client, OTHER_PARENT_RELS_QUERY.format(
+            src=escape_query_value(event_body['$sourceId']), rid=escape_query_value(event_body['$relationshipId'])), cache)
+        if (other_parent_rel):
             logging.error('An asset in CDF can have a single parent, but another parent was added to asset "%s". ' +
                 'Aborting synchronization! Please delete the relationship with ID: "%s" from ADT!', event_body['$sourceId'], event_body['$relationshipId'])
             return False
         # update the parent in CDF
-        a = cdf_client.assets.retrieve(external_id=rel_source.external_id)
+        a = retrieve_cached(cdf_client, 'asset', rel_source.external_id, cache)
         if (a.parent_external_id == rel_target.external_id):
             logging.warning('The parent of "%s" in CDF is already "%s"!', rel_source.external_id, rel_target.external_id)
             return True
         else:
             u = AssetUpdate(external_id=rel_source.external_id).parent_external_id.set(rel_target.external_id)
-            cdf_client.assets.update(u)
+            set_cached(cache, 'asset', rel_source.external_id, cdf_client.assets.update(u))
             return True
 
     ############################## contains relationship ##############################
     elif (event_body['$relationshipName'] == 'contains'):  # timeseries is linked to an asset
         # get other 'contains' relationships and DO NOT change asset if this is a another relationship
-        contain_rels = adt_client.query_twins('SELECT R FROM DIGITALTWINS T JOIN CT RELATED T.contains R ' +
-            'WHERE CT.$dtId = \'' + event_body['$targetId'] + '\'' +
-            ' and R.$relationshipId != \'' + event_body['$relationshipId'] + '\'')
-        if (next(contain_rels, None)):
+        other_contain_rel = query_first_rel(adt_client, OTHER_CONTAIN_RELS_QUERY.format(
+            tgt=escape_query_value(event_body['$targetId']), rid=escape_query_value(event_body['$relationshipId'])), cache)
+        if (other_contain_rel):
             logging.error('A timeseries in CDF can have a single asset linked, but another asset was added to timeseries "%s". ' +
                 'Aborting synchronization! Please delete the relationship with ID: "%s" from ADT!', event_body['$targetId'], event_body['$relationshipId'])
             return False
         # update the linked asset in CDF
-        ts = cdf_client.time_series.retrieve(external_id=rel_target.external_id)
+        ts = retrieve_cached(cdf_client, 'timeseries', rel_target.external_id, cache)
         if (ts.asset_id == rel_source.id):
             logging.warning('The linked asset of "%s" in CDF is already "%s"!', rel_target.external_id, rel_source.external_id)
             return False
         else:
             u = TimeSeriesUpdate(external_id=rel_target.external_id).asset_id.set(rel_source.id)
-            cdf_client.time_series.update(u)
+            set_cached(cache, 'timeseries', rel_target.external_id, cdf_client.time_series.update(u))
             return True
     
     ############################## relatesTo relationship ##############################
     elif (event_body['$relationshipName'] == 'relatesTo'):     # real relationship between assets
-        if (cdf_client.relationships.retrieve(event_body['$relationshipId'])):
+        if (retrieve_cached(cdf_client, 'relationship', event_body['$relationshipId'], cache)):
             logging.warning('The CDF relationship with external ID "%s" already exists!', event_body['$relationshipId'])
             return False
         labels = []
         if ('labels' in event_body):
             labels = event_body['labels'].split(',')
         for l in labels:
-            if not(cdf_client.labels.list(external_id_prefix=l)):
+            if not(list_label_ids(cdf_client, l)):
                 logging.error('Cannot create CDF relationship. The label with the external ID "%s" does not exist!', l)
                 return False
         rel = Relationship(external_id=event_body['$relationshipId'],
             source_external_id=rel_source.external_id, source_type='asset',
             target_external_id=rel_target.external_id, target_type='asset',
             labels=labels)
-        cdf_client.relationships.create([rel])
+        if (create_relationship_deferred(cdf_client, rel, cache)):
+            # the flush reports whether it was actually created
+            logging.info('CDF relationship "%s" queued for creation!', rel.external_id)
+        else:
+            logging.info('CDF relationship "%s" was created!', rel.external_id)
         return True
     else:
         logging.error('The relationship with body: %s cannot be handled by the current solution!', event_body)
         return False
 
 
-def update_relationship(cdf_client: CogniteClient, event_body: dict, event_subject: str) -> bool:
+def update_relationship(cdf_client: CogniteClient, event_body: dict, event_subject: str, cache: dict = None) -> bool:
     '''
     Updates an explicit relationship in CDF (an ADT 'relatesTo' relationship): for now only the labels can be changed.
     :param CogniteClient cdf_client: The CDF client object
     :param dict event_body: body of the cloud event
     :param str event_subject: subject of the cloud event (contains the ADT relationship ID, which is the CDF external ID)
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if relationship was successfully updated
     '''
     if (('patch' not in event_body) or (event_body['patch'][0]['path'] != '/labels')):
@@ -529,35 +1104,33 @@ def update_relationship(cdf_client: CogniteClient, event_body: dict, event_subje
         logging.error('Cannot perform relationship update "%s". Subject "%s" does not point to a proper relationship!', event_body, event_subject)
         return False
     if (('value' in event_body['patch'][0]) and (event_body['patch'][0]['value'])):
-        labels_new = event_body['patch'][0]['value'].split(',')
+        labels_new = list(dict.fromkeys(event_body['patch'][0]['value'].split(',')))   # drop duplicates, keep order
     else:
         labels_new = []
     for l in labels_new:
-        label_definitions = cdf_client.labels.list(external_id_prefix=l)
-        if (not(label_definitions) or (label_definitions[0].external_id != l)):
+        label_ids = list_label_ids(cdf_client, l)
+        if (not(label_ids) or (label_ids[0] != l)):
             logging.warning('The CDF relationship label with external ID "%s" does not exist, creating it now!', l)
             cdf_client.labels.create(LabelDefinition(external_id=l, name=l))
+            list_label_ids.cache_clear()
             break
-    rel = cdf_client.relationships.retrieve(external_id=subject_parts[2])
-    labels_old = list(map(lambda x: x['externalId'], rel.labels))
-    labels_add = []
-    for l in labels_new:
-        if not(l in labels_old):
-            labels_add.append(l)
-    labels_remove = []
-    for l in labels_old:
-        if not(l in labels_new):
-            labels_remove.append(l)
+    flush_pending_relationships(cdf_client, cache, subject_parts[2])
+    rel = retrieve_cached(cdf_client, 'relationship', subject_parts[2], cache)
+    labels_old = [x['externalId'] for x in rel.labels]
+    labels_old_set = set(labels_old)
+    labels_new_set = set(labels_new)
+    labels_add = [l for l in labels_new if l not in labels_old_set]
+    labels_remove = [l for l in labels_old if l not in labels_new_set]
     if ((labels_add) or (labels_remove)):
         rel_update = RelationshipUpdate(external_id=subject_parts[2]).labels.add(labels_add).labels.remove(labels_remove)
-        cdf_client.relationships.update(rel_update)
+        set_cached(cache, 'relationship', subject_parts[2], cdf_client.relationships.update(rel_update))
     else:
         logging.warning('Nothing to update! The labels of relationship "%s" are already up to date!', subject_parts[2])
     return True
 
 
 def delete_relationship(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, event_body: dict,
-    rel_source: Asset, rel_target: Union[Asset, TimeSeries]) -> bool:
+    rel_source: Asset, rel_target: Union[Asset, TimeSeries], cache: dict = None) -> bool:
     '''
     Deletes an existing (implicit/explicit) relationship in CDF.
     :param CogniteClient cdf_client: The CDF client object
@@ -565,6 +1138,7 @@ def delete_relationship(cdf_client: CogniteClient, adt_client: DigitalTwinsClien
     :param dict event_body: body of the cloud event
     :param Asset rel_source: source asset of the relationship to be deleted
     :param Asset|TimeSeries rel_target: target asset/timeseries of the relationship to be deleted
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if relationship was successfully deleted
     '''
     ############################## parent relationship ##############################
@@ -575,26 +1149,21 @@ def delete_relationship(cdf_client: CogniteClient, adt_client: DigitalTwinsClien
             'but the parent is actually "%s" in CDF!', event_body['$sourceId'], event_body['$targetId'], rel_source.parent_external_id)
             return True
         # get other parent relationships and DO NOT change parent if this is another relationship
-        parent_rels = adt_client.query_twins('SELECT R FROM DIGITALTWINS T JOIN CT RELATED T.parent R ' +
-            'WHERE T.$dtId = \'' + event_body['$sourceId'] + '\'' +
-            ' and R.$relationshipId != \'' + event_body['$relationshipId'] + '\'')
-        parent_rels = list(parent_rels)
-        if (len(parent_rels) > 0):  # there are other parents in ADT
+        other_parent_rel = query_first_rel(adt_client, OTHER_PARENT_RELS_QUERY.format(
+            src=escape_query_value(event_body['$sourceId']), rid=escape_query_value(event_body['$relationshipId'])), cache)
+        if (other_parent_rel):  # there are other parents in ADT
             logging.warning('Changing parent in CDF! You are deleting the "%s"->"%s" parent relationship from ADT, but ' +
-            '"%s" is another parent in ADT, setting it in CDF as well!', event_body['$sourceId'], event_body['$targetId'], parent_rels[0]['R']['$targetId'])
-            new_parent_asset = cdf_client.assets.retrieve(external_id=parent_rels[0]['R']['$targetId'])
+            '"%s" is another parent in ADT, setting it in CDF as well!', event_body['$sourceId'], event_body['$targetId'], other_parent_rel['R']['$targetId'])
+            new_parent_asset = resolve_asset(cdf_client, adt_client, other_parent_rel['R']['$targetId'], cache, other_parent_rel.get('CT'))
             if not(new_parent_asset):
-                dt = adt_client.get_digital_twin(parent_rels[0]['R']['$targetId'])
-                new_parent_asset = cdf_client.assets.retrieve(external_id=dt['externalId'])
-                if not(new_parent_asset):
-                    logging.error('The asset with external ID "%d" does not exist in CDF!', dt['externalId'])
-                    return False
+                logging.error('The asset of digital twin "%s" does not exist in CDF!', other_parent_rel['R']['$targetId'])
+                return False
             u = AssetUpdate(external_id=rel_source.external_id).parent_external_id.set(new_parent_asset.external_id)
-            cdf_client.assets.update(u)
+            set_cached(cache, 'asset', rel_source.external_id, cdf_client.assets.update(u))
             return True
         else:
             u = AssetUpdate(external_id=rel_source.external_id).parent_external_id.set(ROOT_EXTERNAL_ID)
-            cdf_client.assets.update(u)
+            set_cached(cache, 'asset', rel_source.external_id, cdf_client.assets.update(u))
             return True
     
     ############################## contains relationship ##############################
@@ -605,32 +1174,28 @@ def delete_relationship(cdf_client: CogniteClient, adt_client: DigitalTwinsClien
             'but the linked asset is different in CDF!', event_body['$sourceId'], event_body['$targetId'])
             return True
         # get other contain relationships and DO NOT change asset if this is another
-        contain_rels = adt_client.query_twins('SELECT R FROM DIGITALTWINS T JOIN CT RELATED T.contains R ' +
-            'WHERE CT.$dtId = \'' + event_body['$targetId'] + '\'' +
-            ' and R.$relationshipId != \'' + event_body['$relationshipId'] + '\'')
-        contain_rels = list(contain_rels)
-        if (len(contain_rels) > 0):  # there are other linked assets in ADT
+        other_contain_rel = query_first_rel(adt_client, OTHER_CONTAIN_RELS_QUERY.format(
+            tgt=escape_query_value(event_body['$targetId']), rid=escape_query_value(event_body['$relationshipId'])), cache)
+        if (other_contain_rel):  # there are other linked assets in ADT
             logging.warning('Changing linked asset in CDF! You are deleting the "%s"->"%s" link relationship from ADT, but ' +
-            '"%s" is another linked asset in ADT, setting it in CDF as well!', event_body['$sourceId'], event_body['$targetId'], contain_rels[0]['R']['$sourceId'])
-            new_linked_asset = cdf_client.assets.retrieve(external_id=contain_rels[0]['R']['$sourceId'])
+            '"%s" is another linked asset in ADT, setting it in CDF as well!', event_body['$sourceId'], event_body['$targetId'], other_contain_rel['R']['$sourceId'])
+            new_linked_asset = resolve_asset(cdf_client, adt_client, other_contain_rel['R']['$sourceId'], cache, other_contain_rel.get('T'))
             if not(new_linked_asset):
-                dt = adt_client.get_digital_twin(contain_rels[0]['R']['$sourceId'])
-                new_linked_asset = cdf_client.assets.retrieve(external_id=dt['externalId'])
-                if not(new_linked_asset):
-                    logging.error('The asset with external ID "%d" does not exist in CDF!', dt['externalId'])
-                    return False
+                logging.error('The asset of digital twin "%s" does not exist in CDF!', other_contain_rel['R']['$sourceId'])
+                return False
             u = TimeSeriesUpdate(external_id=rel_target.external_id).asset_id.set(new_linked_asset.id)
-            cdf_client.time_series.update(u)
+            set_cached(cache, 'timeseries', rel_target.external_id, cdf_client.time_series.update(u))
             return True
         else:
-            root = cdf_client.assets.retrieve(external_id=ROOT_EXTERNAL_ID)
+            root = get_root_asset(cdf_client)
             u = TimeSeriesUpdate(external_id=rel_target.external_id).asset_id.set(root.id)
-            cdf_client.time_series.update(u)
+            set_cached(cache, 'timeseries', rel_target.external_id, cdf_client.time_series.update(u))
             return True
 
     ############################## relatesTo relationship ##############################
     elif (event_body['$relationshipName'] == 'relatesTo'):     # real relationship between assets
-        rel = cdf_client.relationships.retrieve(external_id=event_body['$relationshipId'])
+        flush_pending_relationships(cdf_client, cache, event_body['$relationshipId'])
+        rel = retrieve_cached(cdf_client, 'relationship', event_body['$relationshipId'], cache)
         if (rel):
             if (rel.source_external_id != event_body['$sourceId']):
                 logging.warning('Relationship "%s" not deleted from CDF, because the source asset in CDF ("%s") is different from ADT ("%s")!', event_body['$relationshipId'], rel.source_external_id, event_body['$sourceId'])
@@ -639,6 +1204,7 @@ def delete_relationship(cdf_client: CogniteClient, adt_client: DigitalTwinsClien
                 logging.warning('Relationship "%s" not deleted from CDF, because the target asset in CDF ("%s") is different from ADT ("%s")!', event_body['$relationshipId'], rel.target_external_id, event_body['$targetId'])
                 return True
             cdf_client.relationships.delete(external_id=event_body['$relationshipId'])
+            set_cached(cache, 'relationship', event_body['$relationshipId'], None)
             return True
         else:
             logging.error('Relationship with external ID "%s" does not exist in CDF!', event_body['$relationshipId'])
@@ -648,23 +1214,50 @@ def delete_relationship(cdf_client: CogniteClient, adt_client: DigitalTwinsClien
         return False
 
 
-def check_and_insert_datapoint(cdf_client: CogniteClient, adt_id: str, latest_value: str, timestamp_str: str) -> bool:
+def parse_timestamp_ms(timestamp_str: str) -> float:
+    '''
+    Parses an ADT (UTC, ISO 8601) timestamp like "2023-01-01T12:00:00.000Z".
+    datetime.fromisoformat() is much faster than strptime(), but (before Python 3.11) it does not accept the "Z" suffix
+    nor other than 3 or 6 fractional digits, so strptime() is only used as a fallback.
+    :param str timestamp_str: the timestamp as string
+    :return float: milliseconds since epoch
+    '''
+    dt = None
+    if (timestamp_str.endswith('Z')):
+        try:
+            dt = datetime.fromisoformat(timestamp_str[:-1])
+        except ValueError:
+            pass
+    if (dt is None):
+        dt = datetime.strptime(timestamp_str, '%Y-%m-%dT%H:%M:%S.%fZ')
+    return dt.replace(tzinfo=timezone.utc).timestamp() * 1000
+
+
+def check_and_insert_datapoint(cdf_client: CogniteClient, adt_id: str, latest_value: str, timestamp_str: str, cache: dict = None) -> bool:
     '''
     Add a new datapoint to a CDF timeseries, if the given timestamp if after the current latest value.
     :param CogniteClient cdf_client: The CDF client object
     :param string adt_id: Cloud event subject that detetmines the timeseries
     :param string latest_value: datapoint value
     :param string timestamp_str: datapoint datetime value as string
-    :return bool: True if new datapoint has been added
+    :param dict cache: optional cache of prefetched CDF resources
+    :return bool: True if new datapoint has been added, or queued to be added at the end of the batch
     '''
-    timestamp = datetime.strptime(timestamp_str, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc).timestamp()
-    datapoints = cdf_client.datapoints.retrieve_latest(external_id=adt_id)
-    
-    timeseries = cdf_client.time_series.retrieve(external_id=adt_id)
+    timestamp_ms = parse_timestamp_ms(timestamp_str)
+    # a datapoint waiting to be inserted is always later than the latest one in CDF
+    datapoint = get_pending_latest_datapoint(adt_id, cache)
+    if (datapoint or ((cache is not None) and (adt_id in cache['timeseries']))):
+        timeseries = retrieve_cached(cdf_client, 'timeseries', adt_id, cache)
+        timeseries_future = None
+    else:   # both lookups go to CDF, run them in parallel
+        timeseries_future = _IO_POOL.submit(retrieve_cached, cdf_client, 'timeseries', adt_id, cache)
+    if not(datapoint):
+        datapoints = cdf_client.datapoints.retrieve_latest(external_id=adt_id)
+        datapoint = {'timestamp': datapoints[0].timestamp} if len(datapoints)>0 else None
+    if (timeseries_future):
+        timeseries = timeseries_future.result()
     
-    datapoint = datapoints[0] if len(datapoints)>0 else None
-    
-    if (not(datapoint) or (datapoint.timestamp/1000 < timestamp)):
+    if (not(datapoint) or (datapoint['timestamp'] < timestamp_ms)):
         latest_value_to_insert = latest_value
         try:
             latest_value_to_insert = float(latest_value)
@@ -680,133 +1273,152 @@ def check_and_insert_datapoint(cdf_client: CogniteClient, adt_id: str, latest_va
                 timeseries.created_time = None
                 timeseries.last_updated_time = None
                 cdf_client.time_series.delete(external_id=timeseries.external_id)
-                time.sleep(0.1) # have to wait, otherwise 'create' returns duplicate error (delete in cloud is not fast enough)
-                while (cdf_client.time_series.retrieve(external_id=timeseries.external_id)):
-                    time.sleep(0.1)
-                    pass    # delete operation is async, so make sure timeseries is not in the cloud anymore
-                cdf_client.time_series.create(timeseries)
+                # have to wait, otherwise 'create' returns duplicate error (delete in cloud is not fast enough)
+                if not(wait_for_timeseries_deletion(cdf_client, timeseries.external_id)):
+                    logging.warning('Timeseries "%s" is still in CDF after deleting it, trying to recreate it as string timeseries anyway!', timeseries.external_id)
+                try:
+                    created = cdf_client.time_series.create(timeseries)
+                except CogniteDuplicatedError:
+                    # one last retry, once CDF is done deleting it
+                    wait_for_timeseries_deletion(cdf_client, timeseries.external_id)
+                    try:
+                        created = cdf_client.time_series.create(timeseries)
+                    except CogniteDuplicatedError:
+                        logging.error('Cannot recreate timeseries "%s" as string timeseries, it is still being deleted in CDF! The timeseries is deleted, together with its metadata and asset link, and the datapoint is not inserted!', timeseries.external_id)
+                        set_cached(cache, 'timeseries', timeseries.external_id, None)
+                        return False
+                set_cached(cache, 'timeseries', timeseries.external_id, created)
             else:
                 if not(timeseries.is_string):
                     logging.error('Cannot insert string "%s" into numeric timeseries "%s"!', latest_value_to_insert, timeseries.external_id)
                     return False
-        new_datapoint_value = {'timestamp': timestamp*1000, 'value': latest_value_to_insert}
-        cdf_client.datapoints.insert([new_datapoint_value], external_id=timeseries.external_id)
-        logging.info('New datapoint added with values %s to timeseries "%s"!', new_datapoint_value, adt_id)
+        new_datapoint_value = {'timestamp': timestamp_ms, 'value': latest_value_to_insert}
+        if (insert_datapoint_deferred(cdf_client, timeseries.external_id, new_datapoint_value, cache)):
+            # the flush reports whether it was actually added
+            logging.info('New datapoint queued with values %s for timeseries "%s"!', new_datapoint_value, adt_id)
+        else:
+            logging.info('New datapoint added with values %s to timeseries "%s"!', new_datapoint_value, adt_id)
         return True
 
     return False
 
 
-def create_timeseries(cdf_client, adt_id, event_body) -> bool:
+def wait_for_timeseries_deletion(cdf_client: CogniteClient, external_id: str, timeout: float = 10.0) -> bool:
+    '''
+    Waits until a deleted timeseries is not returned by CDF anymore (the delete operation is asynchronous).
+    CDF is polled with exponential backoff (0.1s, 0.2s, 0.4s, ..., at most 2s between polls).
+    :param CogniteClient cdf_client: The CDF client object
+    :param str external_id: external ID of the deleted timeseries
+    :param float timeout: maximum time to wait, in seconds
+    :return bool: True if the timeseries is gone, False if it is still in CDF after the timeout
+    '''
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+    while (cdf_client.time_series.retrieve(external_id=external_id)):
+        if (time.monotonic() + delay > deadline):
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 2.0)
+    return True
+
+
+def create_timeseries(cdf_client, adt_id, event_body, cache: dict = None) -> bool:
     '''
     Creates a new timeseries in CDF, if it does not exist yet.
     :param CogniteClient cdf_client: The CDF client object
     :param str adt_id: The ID of the timeseries from ADT
     :param dict event_body: body of cloud event holding data about the new timeseries
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if timeseries was successfully created
     '''
-    if not has_timeseries_in_CDF_by_external_id(cdf_client, adt_id):
-        # get root asset object        
-        rootAsset = cdf_client.assets.retrieve(external_id=ROOT_EXTERNAL_ID)
-        
-        # create the new timeseries
-        new_data = TimeSeries(name=adt_id, external_id=adt_id,  asset_id=rootAsset.id)
-        if ('displayName' in event_body):
-            new_data.name = event_body['displayName']
-        else:
-            new_data.name = event_body.get('$dtId')    # name is mandatory in CDF            
-        if ('description' in event_body):
-            new_data.description = event_body['description']
-        if ('values' in event_body['tags']):
-            new_data.metadata = event_body['tags']['values']
-
-        cdf_client.time_series.create(new_data)
-        logging.info('Timeseries "%s" was created!', adt_id)
-        
-        if ('latestValue' in event_body) and ('timestamp' in event_body) and (event_body['latestValue']) and (event_body['timestamp']):
-            # check if latestValue and timestamp is exists in timeseries data
-            check_and_insert_datapoint(cdf_client, adt_id, event_body['latestValue'], event_body['timestamp'])
-    else:
+    if ((cache is not None) and cache['timeseries'].get(adt_id)):     # already known from the prefetched batch
+        logging.warning('CDF timeseries "%s" already exists!', adt_id)
+        return False
+
+    # get root asset object
+    rootAsset = get_root_asset(cdf_client)
+    
+    # create the new timeseries
+    new_data = TimeSeries(external_id=adt_id, asset_id=rootAsset.id,
+        name=event_body.get('displayName', event_body.get('$dtId')),     # name is mandatory in CDF
+        description=event_body.get('description'),
+        metadata=event_body['tags'].get('values'))
+
+    try:    # no existence check in advance, CDF rejects duplicates anyway
+        set_cached(cache, 'timeseries', adt_id, cdf_client.time_series.create(new_data))
+    except CogniteDuplicatedError:
         logging.warning('CDF timeseries "%s" already exists!', adt_id)
         return False
+    logging.info('Timeseries "%s" was created!', adt_id)
+    
+    if (event_body.get('latestValue') and event_body.get('timestamp')):
+        # check if latestValue and timestamp is exists in timeseries data
+        check_and_insert_datapoint(cdf_client, adt_id, event_body['latestValue'], event_body['timestamp'], cache)
     return True
 
 
-def update_timeseries(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, adt_id: str, event_body: dict) -> bool:
+def update_timeseries(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, adt_id: str, event_body: dict, cache: dict = None) -> bool:
     '''
     Updates an existing timeseries in CDF.
     :param CogniteClient cdf_client: The CDF client object
     :param DigitalTwinsClient adt_client: The ADT client object
     :param str adt_id: The ID of the timeseries from ADT
     :param dict event_body: body of cloud event holding data about the timeseries
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if timeseries was successfully updated, or a new datapoint was inserted into it
     '''
-    timeseries_to_update = cdf_client.time_series.retrieve(external_id=adt_id)
+    timeseries_to_update = retrieve_cached(cdf_client, 'timeseries', adt_id, cache)
     if not(timeseries_to_update):  # maybe ID contains special characters
-        dt = adt_client.get_digital_twin(adt_id)
-        if ('externalId' not in dt):
+        external_id = retrieve_cached_twin_external_id(adt_client, adt_id, cache)
+        if not(external_id):
             logging.error('Cannot perform update! CDF timeseries with external ID "%s" does not exist!', adt_id)
             return False
-        timeseries_to_update = cdf_client.time_series.retrieve(external_id=dt['externalId'])
+        timeseries_to_update = retrieve_cached(cdf_client, 'timeseries', external_id, cache)
         if not(timeseries_to_update):
-            logging.error('Cannot perform update! CDF timeseries with external ID "%s" does not exist!', dt['externalId'])
+            logging.error('Cannot perform update! CDF timeseries with external ID "%s" does not exist!', external_id)
             return False
 
-    has_change, timeseries_to_update = fetch_changes_to_CDF_record(cdf_client, timeseries_to_update, event_body)
+    has_change, timeseries_to_update = fetch_changes_to_CDF_record(cdf_client, timeseries_to_update, event_body, cache)
 
     # update timeseries record
     if has_change:
-        cdf_client.time_series.update(timeseries_to_update)
-        #logging.info("CDF time series has been updated with data: %s", timeseries_to_update)
+        set_cached(cache, 'timeseries', timeseries_to_update.external_id, cdf_client.time_series.update(timeseries_to_update))
 
     # update latest datapoint if needed
+    # index the patch operations by path in a single pass (first operation wins), then pair the value with its timestamp
+    patch_ops = {}
+    for action in event_body['patch']:
+        patch_ops.setdefault(action['path'], action)
+    value_op = patch_ops.get('/latestValue')
+    timestamp_op = patch_ops.get('/timestamp')
     has_datapoint = False
-    for action in list(event_body['patch']):
-        # check if the was updated before to close the event loop
-        if action['path']=='/latestValue':
-            if action['op']=='remove':
-                continue
-            else:
-                action_pair = [ action_item for action_item in event_body['patch'] if '/timestamp' in action_item.get('path') ]
-                if len(action_pair) > 0 and action_pair[0].get('op')!='remove':
-                    # delete the pair change from the patch list
-                    event_body['patch'].remove(action_pair[0])
-                    latest_value  = action.get('value')
-                    timestamp_str = action_pair[0].get('value')
-                    has_datapoint = check_and_insert_datapoint(cdf_client, timeseries_to_update.external_id, latest_value, timestamp_str)
-                else:
-                    # if the value pair was removed or not found in the modification list we skip the process of this
-                    continue
+    # if the value or its pair was removed or not found in the modification list we skip inserting the datapoint
+    if ((value_op) and (timestamp_op) and (value_op['op'] != 'remove') and (timestamp_op['op'] != 'remove')):
+        has_datapoint = check_and_insert_datapoint(cdf_client, timeseries_to_update.external_id, value_op.get('value'), timestamp_op.get('value'), cache)
     if (not(has_change) and not(has_datapoint)):
         logging.warning('Nothing to update! Timeseries "%s" and latest value is already up to date!', timeseries_to_update.external_id)
         return True
     return (has_change or has_datapoint)
 
 
-def delete_timeseries(cdf_client: CogniteClient, adt_id: str) -> bool:
+def delete_timeseries(cdf_client: CogniteClient, adt_id: str, cache: dict = None) -> bool:
     '''
     Deletes an existing timeseries from CDF.
     :param CogniteClient cdf_client: The CDF client object
     :param str adt_id: The ID of the timeseries from ADT
+    :param dict cache: optional cache of prefetched CDF resources
     :return bool: True if timeseries was successfully deleted
     '''
-    if has_timeseries_in_CDF_by_external_id(cdf_client, adt_id):
-        cdf_client.time_series.delete(id=None, external_id = adt_id)
-    else:
-        logging.warning('Timeseries "%s" was not found in CDF!', adt_id)
+    if ((cache is not None) and ('pending' in cache)):
+        with cache['pending'].lock:
+            cache['pending'].insert_datapoints.pop(adt_id, None)   # would be deleted together with the timeseries anyway
+    cdf_client.time_series.delete(external_id=adt_id, ignore_unknown_ids=True)
+    set_cached(cache, 'timeseries', adt_id, None)
     return True
 
 
-def has_timeseries_in_CDF_by_external_id(cdf_client: CogniteClient, adt_id: str) -> bool:
-    '''
-    Check if timeseries exists in CDF using cloud event subject as an external ID
-    :param CogniteClient cdf_client: The CDF client object
-    :param str adt_id: The ID of the asset from ADT
-    :return bool: True if timeseries exists
-    '''
-    time_series = cdf_client.time_series.retrieve(external_id=adt_id)
-    # logging.info('asset: %s %s', asset, (asset is not None))
-    return (time_series is not None)
+# replaces the characters of CDF metadata keys that are problematic in ADT, in a single pass over the key
+METADATA_KEY_TRANSLATION = str.maketrans({' ': '_', '.': '^', '$': '#'})
 
 
 def convert_metadata(metadata: dict) -> dict:
@@ -816,15 +1428,44 @@ def convert_metadata(metadata: dict) -> dict:
         '.'     =>  '^'
         '$'     =>  '#'
     WARNING: temporary solution
+    :param dict metadata: CDF metadata
+    :return dict: maps each converted key to the (original key, value) pair
+    '''
+    return {k.translate(METADATA_KEY_TRANSLATION): (k, v) for (k, v) in metadata.items()}
+
+
+def get_root_asset(cdf_client: CogniteClient) -> Asset:
+    '''
+    Retrieves the root asset from CDF, caching it after the first successful retrieval.
+    :param CogniteClient cdf_client: The CDF client object
+    :return Asset: the root asset, or None if it does not exist
+    '''
+    global _ROOT_ASSET
+    if (_ROOT_ASSET is None):
+        _ROOT_ASSET = cdf_client.assets.retrieve(external_id=ROOT_EXTERNAL_ID)
+    return _ROOT_ASSET
+
+
+def _get_or_create_cdf_client() -> CogniteClient:
+    '''
+    Returns the CDF client of the worker process, creating it on first use.
+    '''
+    global _CDF_CLIENT
+    with _CLIENT_LOCK:
+        if (_CDF_CLIENT is None):
+            _CDF_CLIENT = get_cdf_client()
+    return _CDF_CLIENT
+
+
+def _get_or_create_adt_client() -> DigitalTwinsClient:
     '''
-    new_map = {}
-    for k in metadata:
-        kk = k.replace(' ', '_').replace('.', '^').replace('$', '#')
-        new_metadata = MetadataConversion()
-        new_metadata.value = metadata[k]
-        new_metadata.key = k
-        new_map[kk] = new_metadata
-    return new_map
+    Returns the ADT client of the worker process, creating it on first use.
+    '''
+    global _ADT_CLIENT
+    with _CLIENT_LOCK:
+        if (_ADT_CLIENT is None):
+            _ADT_CLIENT = get_adt_client()
+    return _ADT_CLIENT
 
 
 def get_cdf_client() -> CogniteClient:
@@ -851,6 +1492,10 @@ def get_cdf_client() -> CogniteClient:
 
     BASE_URL = f"https://{CDF_CLUSTER}.cognitedata.com"
 
+    # the SDK sizes its connection pool when the first client is created (i.e. right below), with 50 connections by default:
+    # this only makes a difference if MAX_WORKERS is configured above 50
+    global_config.max_connection_pool_size = max(global_config.max_connection_pool_size, MAX_WORKERS)
+
     creds = OAuthClientCredentials(token_url=TOKEN_URL, client_id=CLIENT_ID, scopes=SCOPES, client_secret=CLIENT_SECRET)
     cnf = ClientConfig(client_name="cdf-optimisation", project=COGNITE_PROJECT, credentials=creds, base_url=BASE_URL)
     cdf_client = CogniteClient(cnf)
@@ -871,6 +1516,9 @@ def get_adt_client() -> DigitalTwinsClient:
     """
     url = os.environ["ADT_URL"]
     credential = DefaultAzureCredential()
-    adt_client = DigitalTwinsClient(url, credential)
+    # the default pool keeps 10 connections only, keep one for each thread handling events instead
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_maxsize=MAX_WORKERS))
+    adt_client = DigitalTwinsClient(url, credential, transport=RequestsTransport(session=session))
 
     return adt_client
\ No newline at end of file
@@ -0,0 +1,61 @@
+"""
+Tests of the batch prefetch of CDF resources in the ADT->CDF synchronization.
+The CDF APIs are autospecced from the installed cognite-sdk, so calls with unsupported arguments fail as they would against CDF.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+os.environ.setdefault('ROOT_ASSET_EXTERNAL_ID', 'root')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cognite.client._api.assets import AssetsAPI
+from cognite.client._api.relationships import RelationshipsAPI
+from cognite.client._api.time_series import TimeSeriesAPI
+from cognite.client.data_classes import Asset, Relationship
+from cognite.client.exceptions import CogniteNotFoundError
+
+from ADT2CDFSync.handler import EventRepresentation, prefetch
+
+
+def get_cdf_client() -> mock.Mock:
+    cdf_client = mock.Mock()
+    cdf_client.assets = mock.create_autospec(AssetsAPI, instance=True)
+    cdf_client.time_series = mock.create_autospec(TimeSeriesAPI, instance=True)
+    cdf_client.relationships = mock.create_autospec(RelationshipsAPI, instance=True)
+    cdf_client.assets.retrieve_multiple.return_value = [Asset(external_id='A'), Asset(external_id='B')]
+    cdf_client.time_series.retrieve_multiple.return_value = []
+    return cdf_client
+
+
+def get_relates_to_event(rel_id: str) -> EventRepresentation:
+    event_representation = EventRepresentation()
+    event_representation.type = 'Create'
+    event_representation.resource = 'relationship'
+    event_representation.subject = 'A/relationships/' + rel_id
+    event_representation.body = {'$relationshipId': rel_id, '$relationshipName': 'relatesTo', '$sourceId': 'A', '$targetId': 'B'}
+    return event_representation
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_relationship_event(self):
+        cdf_client = get_cdf_client()
+        cdf_client.relationships.retrieve_multiple.return_value = [Relationship(external_id='r1')]
+        cache = prefetch(cdf_client, [get_relates_to_event('r1')])
+        cdf_client.relationships.retrieve_multiple.assert_called_once_with(external_ids=['r1'])
+        self.assertEqual(cache['relationship']['r1'].external_id, 'r1')
+        self.assertEqual(set(cache['asset']), {'A', 'B'})
+
+    def test_unknown_relationship(self):
+        cdf_client = get_cdf_client()
+        cdf_client.relationships.retrieve_multiple.side_effect = [
+            CogniteNotFoundError(not_found=[{'externalId': 'r2'}]), [Relationship(external_id='r1')]]
+        cache = prefetch(cdf_client, [get_relates_to_event('r1'), get_relates_to_event('r2')])
+        self.assertEqual(cdf_client.relationships.retrieve_multiple.call_args.kwargs, {'external_ids': ['r1']})
+        self.assertEqual(cache['relationship']['r1'].external_id, 'r1')
+        self.assertIsNone(cache['relationship']['r2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
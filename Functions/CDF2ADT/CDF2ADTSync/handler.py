@@ -4,15 +4,23 @@ Timer-triggered Azure function, to synchronize knowledge graph in the CDF->ADT d
 import os
 import logging
 import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from functools import lru_cache
 from datetime import datetime, timezone
-from typing import Tuple, Union
+from typing import Callable, Iterable, Union
 
-from azure.core.exceptions import ResourceNotFoundError
+import requests
+from requests.adapters import HTTPAdapter
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.digitaltwins.core import DigitalTwinsClient
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobClient, BlobServiceClient, ContainerClient, StorageStreamDownloader
-from cognite.client import CogniteClient, ClientConfig
+from cognite.client import CogniteClient, ClientConfig, global_config
 from cognite.client.credentials import OAuthClientCredentials
 from cognite.client.data_classes import Asset, AssetList, TimeSeries
 
@@ -23,33 +31,45 @@ class ADT_MODEL_IDS(Enum):
     TIMESERIES = 'dtmi:digitaltwins:cognite:cdf:TimeSeries;1'
 
 BLOB_CONTAINER_NAME = 'params'
-BLOB_FILE_NAME = 'func_runs.json'   # this file will contain the timestamp of the last synchronization for each root asset
+BLOB_FILE_NAME = 'func_runs.json'   # legacy file containing the timestamp of the last synchronization for each root asset
+BLOB_FOLDER_NAME = 'func_runs'      # the timestamp of the last synchronization of each root asset is in 'func_runs/<root external ID>.json'
 
 SQL_IN_BATCH_SIZE = 100
 SQL_PLACEHOLDER = '<_:_>'
+CDF_FILTER_BATCH_SIZE = 100     # maximum number of asset IDs in a CDF list filter
+
+MAX_WORKERS = int(os.getenv('CDF2ADT_MAX_WORKERS', '16'))   # number of twins/relationships synchronized concurrently
 
 # disable HTTP request and response logs (headers etc.)
 logging.getLogger('azure.core.pipeline.policies.http_logging_policy').setLevel(logging.WARNING)
 
+# clients are reused across invocations handled by the same worker process (keeping their connection pools and tokens)
+_CDF_CLIENT: CogniteClient = None
+_ADT_CLIENT: DigitalTwinsClient = None
+_BLOB_CONTAINER_CLIENT: ContainerClient = None
+_CLIENT_LOCK = threading.Lock()     # invocations may run in concurrent threads of the worker process
+
 
 def handle(root_ext_id: str) -> None:
     # transform CDF asset hierarchy to ADT
     # Step 1: preparations
-    cdf_client = get_cdf_client()
-    adt_client = get_adt_client()
-    root_asset = cdf_client.assets.retrieve(external_id=root_ext_id)
+    cdf_client = _get_or_create_cdf_client()
+    adt_client = _get_or_create_adt_client()
+    # the root asset (CDF), the timestamp of the last synchronization (blob storage) and the root twin (ADT) are independent:
+    # look them up concurrently, so that the preparations take as long as the slowest service instead of their sum
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        root_asset_future = executor.submit(cdf_client.assets.retrieve, external_id=root_ext_id)
+        sync_ts_future = executor.submit(get_last_exec_TS, root_ext_id)
+        twin_exists_future = executor.submit(has_digital_twin, adt_client, convert_ext_id(root_ext_id))
+    root_asset = root_asset_future.result()
     if (root_asset is None):
         logging.error('The root asset with external ID "%s" does not exist in CDF. Aborting synchronization!', root_ext_id)
         return 
 
     # Step 2: create/update digital twin in ADT, based on any modifications in CDF
     # get the timestamp of the last synchronization
-    sync_ts = get_last_exec_TS(root_ext_id)
-    twin_exists = True
-    try:
-        adt_client.get_digital_twin(digital_twin_id=convert_ext_id(root_ext_id))
-    except:
-        twin_exists = False
+    sync_ts = sync_ts_future.result()
+    twin_exists = twin_exists_future.result()
 
     # consistency check
     if (sync_ts) and not(twin_exists):
@@ -60,23 +80,25 @@ def handle(root_ext_id: str) -> None:
         #return
 
     asset_list = cdf_client.assets.retrieve_subtree(external_id=root_ext_id)
+    asset_ext_ids = [a.external_id for a in asset_list]             # external IDs of the CDF assets
+    converted_ext_ids = [convert_ext_id(x) for x in asset_ext_ids]  # IDs of the corresponding digital twins in ADT
     date_now = datetime.utcnow()
     if not(sync_ts):
         logging.info('Creating new ADT digital twins for CDF asset hierarchy with root asset external ID "%s"!', root_ext_id)
         na = insert_assets(adt_client, asset_list)
-        nr = insert_asset_to_asset_relationships(cdf_client, adt_client, asset_list)
+        nr = insert_asset_to_asset_relationships(cdf_client, adt_client, asset_ext_ids)
         nt = insert_timeseries(cdf_client, adt_client, asset_list)
         logging.info('Created %d assets, %d relationships, %d timeseries in ADT!', na, nr, nt)
     else:
         logging.info('Updating existing ADT digital twins for CDF asset hierarchy with root asset external ID "%s"!', root_ext_id)
         ##asset_list = cdf_client.assets.list(root_external_ids=[root_ext_id], 
         ##    last_updated_time={'min': int(sync_ts*1000)})
-        na = update_assets(adt_client, list(filter(lambda x: x.last_updated_time > sync_ts*1000, asset_list)))
-        nr = update_asset_to_asset_relationships(cdf_client, adt_client, asset_list, sync_ts)
+        na = update_assets(adt_client, [a for a in asset_list if (a.last_updated_time > sync_ts*1000)])
+        nr = update_asset_to_asset_relationships(cdf_client, adt_client, asset_ext_ids, converted_ext_ids, sync_ts)
         nt = update_timeseries(cdf_client, adt_client, asset_list, sync_ts)
-        nad = delete_assets(adt_client, asset_list[1:], root_ext_id)    # skip root node
-        nrd = delete_asset_to_asset_relationships(cdf_client, adt_client, asset_list)
-        ntd = delete_timeseries(cdf_client, adt_client, asset_list)
+        nad = delete_assets(adt_client, converted_ext_ids[1:], root_ext_id)    # skip root node
+        nrd = delete_asset_to_asset_relationships(cdf_client, adt_client, asset_ext_ids, converted_ext_ids)
+        ntd = delete_timeseries(cdf_client, adt_client, asset_list, converted_ext_ids)
         logging.info('Updated %d assets, %d relationships, %d timeseries in ADT!', na, nr, nt)
         logging.info('Deleted %d assets, %d relationships, %d timeseries in ADT!', nad, nrd, ntd)
     set_last_exec_TS(root_ext_id, date_now.timestamp())
@@ -91,34 +113,31 @@ def insert_assets(adt_client: DigitalTwinsClient, asset_list: AssetList) -> int:
     :param AssetList asset_list: The list of CDF assets
     :return int: number of assets inserted
     '''
-    n = 0
-    for a in asset_list:
-        ##print(a.external_id)
-        create_twin(a, adt_client)
-        n = n+1
-    return n
+    # all twins first, then the parent relationships: the parent twin has to exist when the relationship is inserted
+    run_concurrently(lambda a: create_twin(a, adt_client, insert_parent=False), asset_list)
+    run_concurrently(lambda a: insert_adt_relationship(adt_client, convert_ext_id(a.external_id), convert_ext_id(a.parent_external_id), 'parent'),
+        [a for a in asset_list if a.parent_external_id])
+    return len(asset_list)
 
 
-def insert_asset_to_asset_relationships(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, asset_list: AssetList) -> int:
+def insert_asset_to_asset_relationships(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, asset_ext_ids: list) -> int:
     '''
     Retrieves the list of CDF relationships from asset to asset, and inserts them into ADT.
     :param CogniteClient cdf_client: The CDF client object
     :param DigitalTwinsClient adt_client: The ADT client object
-    :param AssetList asset_list: The list of CDF assets
+    :param list asset_ext_ids: The external IDs of the CDF assets
     :return int: number of relationships inserted
     '''
-    n = 0
-    asset_external_ids = list(map(lambda x: x.external_id, asset_list))
     rel_list = cdf_client.relationships.list(
-        source_external_ids=asset_external_ids, 
-        target_external_ids=asset_external_ids, 
+        source_external_ids=asset_ext_ids, 
+        target_external_ids=asset_ext_ids, 
         limit=-1)
-    for rel in rel_list:
-        n = n+1
+    def insert_relationship(rel):
         labels = ','.join(list(map(lambda x: x['externalId'], rel.labels)))   # e.g. result: 'contains,flowsTo'
         insert_adt_relationship(adt_client, convert_ext_id(rel.source_external_id), convert_ext_id(rel.target_external_id), 
             'relatesTo', rel.external_id, labels)
-    return n
+    run_concurrently(insert_relationship, rel_list)
+    return len(rel_list)
 
 
 def insert_timeseries(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, asset_list: AssetList) -> int:
@@ -130,31 +149,19 @@ def insert_timeseries(cdf_client: CogniteClient, adt_client: DigitalTwinsClient,
     :param AssetList asset_list: The list of CDF assets linked to the timeseries
     :return int: number of timeseries inserted
     '''
-    n = 0
-    # for each asset get the linked timeseries
-    for a in asset_list:
+    # get the linked timeseries and their latest datapoints of all assets at once, then handle the assets concurrently
+    ts_by_asset = list_timeseries_by_asset(cdf_client, asset_list)
+    latest_datapoints = retrieve_latest_datapoints(cdf_client, [t.external_id for ts_list in ts_by_asset.values() for t in ts_list])
+    def insert_asset_timeseries(a: Asset) -> int:
+        n = 0
         asset_ext_id = convert_ext_id(a.external_id)
-        ts_list = cdf_client.time_series.list(asset_external_ids=[a.external_id], limit=-1)
-        if not(ts_list):
-            continue
+        ts_list = ts_by_asset.get(a.id, [])
         # create the corresponding digital twins for each timeseries
         for t in ts_list:
             n = n+1
-            ext_id = convert_ext_id(t.external_id)
-            langString = t.description if t.description else ''
-            ts = cdf_client.datapoints.retrieve_latest(external_id=t.external_id)
-            if (ts):
-                d = ts[0]
-            else:
-                d = None
-            ##print(asset_ext_id, len(ts_list), d.value, d.timestamp)
-            temp_twin = get_twin_dict(t, ADT_MODEL_IDS.TIMESERIES)
-            if (d):
-                temp_twin['latestValue'] = str(d.value)
-                temp_twin['timestamp'] = datetime.fromtimestamp(d.timestamp/1000, tz=timezone.utc)
-            adt_client.upsert_digital_twin(ext_id, temp_twin)
-            insert_adt_relationship(adt_client, asset_ext_id, ext_id, 'contains')
-    return n
+            create_timeseries_twin(adt_client, t, latest_datapoints.get(t.external_id), asset_ext_id)
+        return n
+    return sum(run_concurrently(insert_asset_timeseries, asset_list))
 
 
 def update_assets(adt_client: DigitalTwinsClient, asset_list: AssetList) -> int:
@@ -166,12 +173,24 @@ def update_assets(adt_client: DigitalTwinsClient, asset_list: AssetList) -> int:
     :return int: number of assets updated
     '''
     n = 0
+    # retrieve the current parent relationships of all the twins at once (the first one of each twin is kept)
+    sql_query = 'SELECT R FROM DIGITALTWINS T JOIN CT RELATED T.parent R WHERE T.$dtId in ' + SQL_PLACEHOLDER
+    parent_rels_adt = {}
+    for r in query_adt_batches(adt_client, sql_query, [convert_ext_id(a.external_id) for a in asset_list if a.parent_external_id]):
+        parent_rels_adt.setdefault(r['R']['$sourceId'], r['R'])
+    # retrieve the twins at once, then update them in order (a new twin needs its parent to exist already)
+    twins_adt = query_twins_by_id(adt_client, [convert_ext_id(a.external_id) for a in asset_list])
     for a in asset_list:
         ext_id = convert_ext_id(a.external_id)
         parent_ext_id = convert_ext_id(a.parent_external_id)
+        dt = twins_adt.get(ext_id)
+        if (dt is None):
+            n = n+1
+            # this is a new digital twin
+            create_twin(a, adt_client)
+            continue
         
         try:
-            dt = adt_client.get_digital_twin(digital_twin_id=ext_id)
             update_patches = get_update_patches(a, dt)
             if (update_patches):
                 n = n+1
@@ -180,8 +199,7 @@ def update_assets(adt_client: DigitalTwinsClient, asset_list: AssetList) -> int:
             # verify parent change
             if not(parent_ext_id):  # this is the root asset
                 continue
-            rel_list_adt = adt_client.list_relationships(ext_id)
-            rela = next((r for r in rel_list_adt if ((r['$sourceId'] == ext_id) and (r['$relationshipName'] == 'parent'))), None)
+            rela = parent_rels_adt.get(ext_id)
             if not(rela):   # relationship does not exist in ADT
                 logging.warning('Skipping parent update for asset "%s", because it is not provided in ADT yet!', ext_id)
                 continue
@@ -202,18 +220,18 @@ def update_assets(adt_client: DigitalTwinsClient, asset_list: AssetList) -> int:
     return n
 
 
-def update_asset_to_asset_relationships(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, asset_list: AssetList, sync_ts: float) -> int:
+def update_asset_to_asset_relationships(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, asset_ext_ids: list, converted_ext_ids: list, sync_ts: float) -> int:
     '''
     Compares CDF asset-to-asset relationships with digital twin relationships from ADT, and
     updates the changes, or recreates the relationship if source or target was modified.
     :param CogniteClient cdf_client: The CDF client object
     :param DigitalTwinsClient adt_client: The ADT client object
-    :param AssetList asset_list: The list of CDF assets to check relationships between
+    :param list asset_ext_ids: The external IDs of the CDF assets to check relationships between
+    :param list converted_ext_ids: The IDs of the digital twins corresponding to these assets
     :param float sync_ts: timestamp of the last synchronization
     :return int: number of relationships updated
     '''
     n = 0
-    asset_ext_ids = list(map(lambda x: x.external_id, asset_list))
     rel_list_cdf = cdf_client.relationships.list(
         source_external_ids=asset_ext_ids, 
         target_external_ids=asset_ext_ids, 
@@ -224,13 +242,16 @@ def update_asset_to_asset_relationships(cdf_client: CogniteClient, adt_client: D
 
     # retrieve all corresponding relationships from ADT
     sql_query = 'SELECT R FROM DIGITALTWINS T JOIN CT RELATED T.relatesTo R WHERE T.$dtId in ' + SQL_PLACEHOLDER
-    rel_list_adt = query_adt_batches(adt_client, sql_query, list(map(lambda x: convert_ext_id(x), asset_ext_ids)))
+    rel_list_adt = query_adt_batches(adt_client, sql_query, converted_ext_ids)
+    rels_adt_by_id = {}
+    for r in rel_list_adt:
+        rels_adt_by_id.setdefault(r['R']['$relationshipId'], r['R'])   # keep the first one, as a linear search would
 
     for rel in rel_list_cdf:
         source_ext_id = convert_ext_id(rel.source_external_id)
         target_ext_id = convert_ext_id(rel.target_external_id)
         labels = ','.join(list(map(lambda x: x['externalId'], rel.labels)))   # e.g. result: 'contains,flowsTo'
-        rela = next((r['R'] for r in rel_list_adt if r['R']['$relationshipId'] == rel.external_id), None)
+        rela = rels_adt_by_id.get(rel.external_id)
         if (not(rela) or target_ext_id != rela['$targetId'] or source_ext_id != rela['$sourceId']):
             # if-case: the relationship needs to be recreated in ADT if target/source changed or it does not exist yet at all
             n = n+1
@@ -266,37 +287,38 @@ def update_timeseries(cdf_client: CogniteClient, adt_client: DigitalTwinsClient,
     :param float sync_ts: timestamp of the last synchronization
     :return int: number of timeseries updated
     '''
-    n = 0
-    # for each asset get the linked timeseries
-    for a in asset_list:
+    # get the linked timeseries and their latest datapoints of all assets at once, then handle the assets concurrently
+    ts_by_asset = list_timeseries_by_asset(cdf_client, asset_list)
+    latest_datapoints = retrieve_latest_datapoints(cdf_client, [t.external_id for ts_list in ts_by_asset.values() for t in ts_list])
+    # retrieve the current 'contains' relationships of the timeseries modified since the last sync at once (the first one of each twin is kept)
+    sql_query = 'SELECT R FROM DIGITALTWINS T JOIN CT RELATED T.contains R WHERE CT.$dtId in ' + SQL_PLACEHOLDER
+    modified_ts_ext_ids = [convert_ext_id(t.external_id) for ts_list in ts_by_asset.values() for t in ts_list if (t.last_updated_time > sync_ts*1000)]
+    contain_rels_adt = {}
+    for r in query_adt_batches(adt_client, sql_query, modified_ts_ext_ids):
+        contain_rels_adt.setdefault(r['R']['$targetId'], r['R'])
+    twins_adt = query_twins_by_id(adt_client, [convert_ext_id(t.external_id) for ts_list in ts_by_asset.values() for t in ts_list])
+    def update_asset_timeseries(a: Asset) -> int:
+        n = 0
         asset_ext_id = convert_ext_id(a.external_id)
-        ts_list = cdf_client.time_series.list(asset_external_ids=[a.external_id], limit=-1)
-        if not(ts_list):
-            continue
+        ts_list = ts_by_asset.get(a.id, [])
         # create the corresponding digital twins for each timeseries
         for t in ts_list:
             ext_id = convert_ext_id(t.external_id)
-            ts = cdf_client.datapoints.retrieve_latest(external_id=t.external_id)
-            if (ts):
-                datapoint = ts[0]
-            else:
-                datapoint = None
+            datapoint = latest_datapoints.get(t.external_id)
             ##print(asset_ext_id, t, d.value, d.timestamp)
+            dt = twins_adt.get(ext_id)
+            if (dt is None):
+                n = n+1
+                # this is a new digital twin
+                create_timeseries_twin(adt_client, t, datapoint, asset_ext_id)
+                continue
             try:
-                dt = adt_client.get_digital_twin(digital_twin_id=ext_id)
                 # get update patches for Timeseries resource
                 update_patches = get_update_patches(t, dt)
                 # check if the latest datapoint has changed and extend update patches list
                 
-                if 'timestamp' in dt:
-                    try:
-                        dt_datetime = datetime.strptime(dt['timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ')
-                    except:
-                        dt_datetime = datetime.strptime(dt['timestamp'], '%Y-%m-%dT%H:%M:%SZ')
-                else:
-                    dt_datetime = datetime.strptime('1970-01-01T00:00:00Z', '%Y-%m-%dT%H:%M:%SZ')               
-                if (datapoint and (str(datapoint.value) != dt['latestValue'] or \
-                    datapoint.timestamp/1000 > dt_datetime.replace(tzinfo=timezone.utc).timestamp())):
+                dt_timestamp_ms = parse_timestamp_ms(dt['timestamp']) if ('timestamp' in dt) else 0
+                if (datapoint and (str(datapoint.value) != dt['latestValue'] or datapoint.timestamp > dt_timestamp_ms)):
                     update_patches.append({'op': 'replace', 'path': '/latestValue', 'value': str(datapoint.value)})
                     update_patches.append({'op': 'replace', 'path': '/timestamp', 'value': datetime.fromtimestamp(datapoint.timestamp/1000, tz=timezone.utc)})
                 
@@ -306,129 +328,227 @@ def update_timeseries(cdf_client: CogniteClient, adt_client: DigitalTwinsClient,
                 
                 # check if asset linked to timeseries changed => relationship needs to be recreated
                 if (t.last_updated_time > sync_ts*1000):
-                    rel_list_adt = adt_client.list_incoming_relationships(ext_id)
-                    rela = next((r for r in list(rel_list_adt) if (r.relationship_name == 'contains')), None)
+                    rela = contain_rels_adt.get(ext_id)
                     if not(rela):   # relationship does not exist in ADT
                         logging.warning('Skipping linked asset update for timeseries asset "%s", because it is not provided in ADT yet!', ext_id)
                         continue
-                    if (rela.source_id != asset_ext_id):    # linked asset has changed
-                        if (rela.relationship_id != rela.source_id + '->' + ext_id):
+                    if (rela['$sourceId'] != asset_ext_id):    # linked asset has changed
+                        if (rela['$relationshipId'] != rela['$sourceId'] + '->' + ext_id):
                             logging.warning('The linked asset relationship with ID "%s", between the "%s" asset and "%s" timeseries twins was likely not created' + 
                                 'by CDF->ADT sync, and the ADT->CDF sync might have failed. Still, updating linked asset to "%s" now!', 
-                                rela.relationship_id, rela.source_id, ext_id, asset_ext_id)
+                                rela['$relationshipId'], rela['$sourceId'], ext_id, asset_ext_id)
                         if not(update_patches):  # twin was not updated, but linked asset was, so count this occurrence
                             n = n+1
-                        adt_client.delete_relationship(rela.source_id, rela.relationship_id)
+                        adt_client.delete_relationship(rela['$sourceId'], rela['$relationshipId'])
                         insert_adt_relationship(adt_client, asset_ext_id, ext_id, 'contains')
             except ResourceNotFoundError:
                 n = n+1
-                # this is a new digital twin
-                temp_twin = get_twin_dict(t, ADT_MODEL_IDS.TIMESERIES)
-                if (datapoint):
-                    temp_twin['latestValue'] = str(datapoint.value)
-                    temp_twin['timestamp'] = datetime.fromtimestamp(datapoint.timestamp/1000, tz=timezone.utc)
-                adt_client.upsert_digital_twin(ext_id, temp_twin)
-                # WARNING: external ID might have changed in CDF, this is not handled for now
-                insert_adt_relationship(adt_client, asset_ext_id, ext_id, 'contains')
-    return n
+                # the twin was deleted in the meantime, create it again
+                create_timeseries_twin(adt_client, t, datapoint, asset_ext_id)
+        return n
+    return sum(run_concurrently(update_asset_timeseries, asset_list))
 
 
-def delete_assets(adt_client: DigitalTwinsClient, asset_list: AssetList, root_ext_id: str) -> int:
+def delete_assets(adt_client: DigitalTwinsClient, converted_ext_ids: list, root_ext_id: str) -> int:
     '''
     Deletes digital twins from ADT corresponding to assets not present in CDF anymore.
     Also, for each twin all relationships (both outgoing and indoming) are deleted from ADT.
     :param DigitalTwinsClient adt_client: The ADT client object
-    :param AssetList asset_list: The list of CDF assets
+    :param list converted_ext_ids: The IDs of the digital twins corresponding to the CDF assets
     :param str root_ext_id: The external ID of the root asset, for which the graph should be checked
     :return int: number of assets deleted
     '''
-    n = 0
-    asset_ext_ids = list(map(lambda x: convert_ext_id(x.external_id), asset_list))
-    root_dt = adt_client.get_digital_twin(convert_ext_id(root_ext_id))
-    twin_list = []          # list of all digital twins under this root node
-    twin_prev = [root_dt]   # list of digital twins from the previous level of the tree (start at level 0, i.e. root node)
-    # loop through all twins from the previous level until leaf nodes are reached
+    asset_ext_ids = set(converted_ext_ids)
+    twin_ids = []           # IDs of all digital twins under this root node
+    twin_prev = [convert_ext_id(root_ext_id)]  # IDs of the twins from the previous level of the tree (start at level 0, i.e. root node)
+    seen = set(twin_prev)
+    # loop through all twins from the previous level until leaf nodes are reached, querying the children of a whole level at once
+    sql_query = 'SELECT T.$dtId as dtId FROM DIGITALTWINS T JOIN CT RELATED T.parent R WHERE CT.$dtId in ' + SQL_PLACEHOLDER
     while (twin_prev):
-        twin_children = []
-        for dt in twin_prev:
-            rels = adt_client.list_incoming_relationships(dt['$dtId'])
-            for r in rels:      # find parent relationship
-                if (r.relationship_name == 'parent'):   # add children to list
-                    twin_children.append(adt_client.get_digital_twin(r.source_id))
-        twin_list.extend(twin_children)
+        twin_children = [x for x in dict.fromkeys(r['dtId'] for r in query_adt_batches(adt_client, sql_query, twin_prev)) if (x not in seen)]
+        seen.update(twin_children)
+        twin_ids.extend(twin_children)
         twin_prev = twin_children
     # delete assets from ADT that are not present in CDF
     # together with all relationships (both outgoing and incoming)
-    for i in range(len(twin_list)-1, -1, -1):
-        dt_id = twin_list[i]['$dtId']
-        if (dt_id not in asset_ext_ids):
-            n = n+1
-            rels = adt_client.list_relationships(dt_id)
-            for r in rels:
-                adt_client.delete_relationship(dt_id, r['$relationshipId'])
-            rels = adt_client.list_incoming_relationships(dt_id)
-            for r in rels:
-                adt_client.delete_relationship(r.source_id, r.relationship_id)
-            adt_client.delete_digital_twin(dt_id)
-    return n
+    def delete_twin(dt_id: str) -> None:
+        # a relationship between two deleted twins is deleted by whichever gets to it first
+        for r in adt_client.list_relationships(dt_id):
+            delete_adt_relationship(adt_client, dt_id, r['$relationshipId'])
+        for r in adt_client.list_incoming_relationships(dt_id):
+            delete_adt_relationship(adt_client, r.source_id, r.relationship_id)
+        adt_client.delete_digital_twin(dt_id)
+    twins_to_delete = [dt_id for dt_id in twin_ids if (dt_id not in asset_ext_ids)]
+    run_concurrently(delete_twin, twins_to_delete)
+    return len(twins_to_delete)
 
 
-def delete_asset_to_asset_relationships(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, asset_list: AssetList) -> int:
+def delete_asset_to_asset_relationships(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, asset_ext_ids: list, converted_ext_ids: list) -> int:
     '''
     Deletes asset-to-asset relationships from ADT that are not present in CDF anymore.
     :param CogniteClient cdf_client: The CDF client object
     :param DigitalTwinsClient adt_client: The ADT client object
-    :param AssetList asset_list: The list of CDF assets to check relationships between
+    :param list asset_ext_ids: The external IDs of the CDF assets to check relationships between
+    :param list converted_ext_ids: The IDs of the digital twins corresponding to these assets
     :return int: number of relationships deleted
     '''
-    n = 0
-    asset_ext_ids = list(map(lambda x: x.external_id, asset_list))
     rel_list_cdf = cdf_client.relationships.list(source_external_ids=asset_ext_ids, target_external_ids=asset_ext_ids, limit=-1)
-    rel_ext_ids = list(map(lambda x: x.external_id, rel_list_cdf))
+    rel_ext_ids = {r.external_id for r in rel_list_cdf}
     # retrieve all relationships from ADT
     sql_query = 'SELECT R FROM DIGITALTWINS T JOIN CT RELATED T.relatesTo R WHERE T.$dtId in ' + SQL_PLACEHOLDER
-    rel_list_adt = query_adt_batches(adt_client, sql_query, list(map(lambda x: convert_ext_id(x), asset_ext_ids)))
-    for r in rel_list_adt:  # delete the ones not present in CDF anymore
-        if not(r['R']['$relationshipId'] in rel_ext_ids):
-            n = n+1
-            adt_client.delete_relationship(r['R']['$sourceId'], r['R']['$relationshipId'])
-    return n
+    rel_list_adt = query_adt_batches(adt_client, sql_query, converted_ext_ids)
+    # delete the ones not present in CDF anymore
+    rels_to_delete = [r['R'] for r in rel_list_adt if not(r['R']['$relationshipId'] in rel_ext_ids)]
+    run_concurrently(lambda r: adt_client.delete_relationship(r['$sourceId'], r['$relationshipId']), rels_to_delete)
+    return len(rels_to_delete)
 
 
-def delete_timeseries(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, asset_list: AssetList) -> int:
+def delete_timeseries(cdf_client: CogniteClient, adt_client: DigitalTwinsClient, asset_list: AssetList, converted_ext_ids: list) -> int:
     '''
     Deletes digital twins from ADT corresponding to timeseries not present in CDF anymore.
+    The timeseries are listed for the given assets only: the ones missing from that list are looked up by external ID,
+    so that a timeseries linked to an asset outside the list (e.g. of another hierarchy) keeps its twin.
     For each twin the relationships connecting it to an asset is also deleted.
     :param CogniteClient cdf_client: The CDF client object
     :param DigitalTwinsClient adt_client: The ADT client object
     :param AssetList asset_list: The list of CDF assets linked to the timeseries
+    :param list converted_ext_ids: The IDs of the digital twins corresponding to these assets
     :return int: number of timeseries deleted
     '''
-    n = 0
-    asset_ext_ids = list(map(lambda x: x.external_id, asset_list))
-    ts_list_cdf = cdf_client.time_series.list(limit=-1)
-    ts_ext_ids = list(map(lambda x: convert_ext_id(x.external_id), ts_list_cdf))
+    ts_ext_ids = {convert_ext_id(t.external_id) for ts_list in list_timeseries_by_asset(cdf_client, asset_list).values() for t in ts_list}
     # retrieve all timeseries from ADT under the given assets
-    sql_query = 'SELECT T.$dtId as assetId, CT.$dtId as tsId, R.$relationshipId as relId ' + \
+    sql_query = 'SELECT T.$dtId as assetId, CT.$dtId as tsId, CT.externalId as tsExtId, R.$relationshipId as relId ' + \
         'FROM DIGITALTWINS T JOIN CT RELATED T.contains R WHERE T.$dtId in ' + SQL_PLACEHOLDER + \
         ' and CT.$metadata.$model = \'' + ADT_MODEL_IDS.TIMESERIES.value + '\''
-    ts_list_adt = query_adt_batches(adt_client, sql_query, list(map(lambda x: convert_ext_id(x), asset_ext_ids)))
-    for ts in ts_list_adt:
-        if (ts['tsId'] not in ts_ext_ids):
-            n = n+1
-            adt_client.delete_relationship(ts['assetId'], ts['relId'])
-            adt_client.delete_digital_twin(ts['tsId'])
-    return n
+    ts_list_adt = query_adt_batches(adt_client, sql_query, converted_ext_ids)
+    def delete_timeseries_twin(ts: dict) -> None:
+        adt_client.delete_relationship(ts['assetId'], ts['relId'])
+        adt_client.delete_digital_twin(ts['tsId'])
+    ts_to_delete = [ts for ts in ts_list_adt if (ts['tsId'] not in ts_ext_ids)]
+    # the twin holds the original CDF external ID, in case it had to be converted (twins of older versions may not have it)
+    candidate_ext_ids = list(dict.fromkeys(ts.get('tsExtId') or ts['tsId'] for ts in ts_to_delete))
+    if (candidate_ext_ids):
+        existing = {t.external_id for t in cdf_client.time_series.retrieve_multiple(external_ids=candidate_ext_ids, ignore_unknown_ids=True)}
+        ts_to_delete = [ts for ts in ts_to_delete if ((ts.get('tsExtId') or ts['tsId']) not in existing)]
+    run_concurrently(delete_timeseries_twin, ts_to_delete)
+    return len(ts_to_delete)
 
 
 ###############################################################################
 ############################## utility functions ##############################
 ###############################################################################
-def create_twin(a: Asset, adt_client: DigitalTwinsClient) -> None:
+def run_concurrently(func: Callable, items: Iterable) -> list:
+    '''
+    Calls the function for each item, with up to MAX_WORKERS calls running at the same time.
+    The calls must be independent of each other, as their order is not defined.
+    :param Callable func: the function to call
+    :param Iterable items: the items to call the function with
+    :return list: the results of the calls, in the order of the items
+    '''
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(func, items))
+
+
+def list_timeseries_by_asset(cdf_client: CogniteClient, asset_list: AssetList) -> dict:
+    '''
+    Retrieves the CDF timeseries linked to the given assets, with one request per CDF_FILTER_BATCH_SIZE assets.
+    :param CogniteClient cdf_client: The CDF client object
+    :param AssetList asset_list: The list of CDF assets
+    :return dict: the list of linked timeseries for each asset ID (assets without timeseries are missing)
+    '''
+    ts_by_asset = {}
+    asset_ids = [a.id for a in asset_list]
+    n = CDF_FILTER_BATCH_SIZE
+    for id_batch in [asset_ids[i:i+n] for i in range(0, len(asset_ids), n)]:
+        for t in cdf_client.time_series.list(asset_ids=id_batch, limit=-1):
+            ts_by_asset.setdefault(t.asset_id, []).append(t)
+    return ts_by_asset
+
+
+def retrieve_latest_datapoints(cdf_client: CogniteClient, external_ids: list) -> dict:
+    '''
+    Retrieves the latest datapoint of the given CDF timeseries, with one request per CDF_FILTER_BATCH_SIZE timeseries.
+    :param CogniteClient cdf_client: The CDF client object
+    :param list external_ids: the external IDs of the timeseries
+    :return dict: the latest datapoint for each timeseries external ID (timeseries without datapoints are missing)
+    '''
+    latest_datapoints = {}
+    n = CDF_FILTER_BATCH_SIZE
+    for id_batch in [external_ids[i:i+n] for i in range(0, len(external_ids), n)]:
+        for dps in cdf_client.datapoints.retrieve_latest(external_id=id_batch, ignore_unknown_ids=True):
+            if (dps):
+                latest_datapoints[dps.external_id] = dps[0]
+    return latest_datapoints
+
+
+def parse_timestamp_ms(timestamp_str: str) -> float:
+    '''
+    Parses an ADT (UTC, ISO 8601) timestamp like "2023-01-01T12:00:00.000Z" or "2023-01-01T12:00:00Z".
+    datetime.fromisoformat() is much faster than strptime(), but (before Python 3.11) it does not accept the "Z" suffix
+    nor other than 3 or 6 fractional digits, so strptime() is only used as a fallback.
+    :param str timestamp_str: the timestamp as string
+    :return float: milliseconds since epoch
+    '''
+    try:
+        dt_datetime = datetime.fromisoformat(timestamp_str[:-1] if timestamp_str.endswith('Z') else timestamp_str)
+    except ValueError:
+        try:
+            dt_datetime = datetime.strptime(timestamp_str, '%Y-%m-%dT%H:%M:%S.%fZ')
+        except ValueError:
+            dt_datetime = datetime.strptime(timestamp_str, '%Y-%m-%dT%H:%M:%SZ')
+    return dt_datetime.replace(tzinfo=timezone.utc).timestamp() * 1000
+
+
+def create_timeseries_twin(adt_client: DigitalTwinsClient, t: TimeSeries, datapoint, asset_ext_id: str) -> None:
+    '''
+    Creates the digital twin in ADT for the given timeseries from CDF, together with the relationship to its linked asset.
+    :param DigitalTwinsClient adt_client: The ADT client object
+    :param TimeSeries t: The CDF timeseries object
+    :param Datapoint datapoint: The latest datapoint of the timeseries, or None if it has no datapoints
+    :param str asset_ext_id: The ID of the digital twin of the linked asset
+    :return: None
+    '''
+    ext_id = convert_ext_id(t.external_id)
+    temp_twin = get_twin_dict(t, ADT_MODEL_IDS.TIMESERIES)
+    if (datapoint):
+        temp_twin['latestValue'] = str(datapoint.value)
+        temp_twin['timestamp'] = datetime.fromtimestamp(datapoint.timestamp/1000, tz=timezone.utc)
+    adt_client.upsert_digital_twin(ext_id, temp_twin)
+    # WARNING: external ID might have changed in CDF, this is not handled for now
+    insert_adt_relationship(adt_client, asset_ext_id, ext_id, 'contains')
+
+
+def query_twins_by_id(adt_client: DigitalTwinsClient, dt_ids: list[str]) -> dict:
+    '''
+    Retrieves the digital twins with the given IDs from ADT, with one query per SQL_IN_BATCH_SIZE twins.
+    :param DigitalTwinsClient adt_client: The ADT client object
+    :param list[str] dt_ids: The IDs of the twins
+    :return dict: the digital twin for each ID (twins that do not exist are missing)
+    '''
+    sql_query = 'SELECT * FROM DIGITALTWINS T WHERE T.$dtId in ' + SQL_PLACEHOLDER
+    return {dt['$dtId']: dt for dt in query_adt_batches(adt_client, sql_query, dt_ids)}
+
+
+def delete_adt_relationship(adt_client: DigitalTwinsClient, source_ext_id: str, rel_id: str) -> None:
+    '''
+    Deletes a relationship from ADT, if it still exists.
+    :param DigitalTwinsClient adt_client: The ADT client object
+    :param str source_ext_id: The ID of the source twin
+    :param str rel_id: The ID of the relationship
+    :return: None
+    '''
+    try:
+        adt_client.delete_relationship(source_ext_id, rel_id)
+    except ResourceNotFoundError:
+        pass
+
+
+def create_twin(a: Asset, adt_client: DigitalTwinsClient, insert_parent: bool = True) -> None:
     '''
     Creates the digital twin in ADT for the given asset from CDF, together with the implicit parent relationship.
     :param Asset a: The CDF asset object
     :param DigitalTwinsClient adt_client: The ADT client object
+    :param bool insert_parent: False if the parent relationship is inserted separately (e.g. once the parent twin exists)
     :return: None
     '''
     temp_twin = get_twin_dict(a, ADT_MODEL_IDS.ASSET)
@@ -438,7 +558,7 @@ def create_twin(a: Asset, adt_client: DigitalTwinsClient) -> None:
     try:
         adt_client.upsert_digital_twin(ext_id, temp_twin)
 
-        if (a.parent_external_id):
+        if (insert_parent and a.parent_external_id):
             insert_adt_relationship(adt_client, ext_id, parent_ext_id, 'parent')
     
     except Exception as e:
@@ -473,6 +593,20 @@ def get_twin_dict(resource: Union[Asset, TimeSeries], model: ADT_MODEL_IDS) -> d
     return twin_dict
 
 
+def has_digital_twin(adt_client: DigitalTwinsClient, dt_id: str) -> bool:
+    '''
+    Checks if the digital twin with the given ID can be retrieved from ADT.
+    :param DigitalTwinsClient adt_client: The ADT client object
+    :param str dt_id: The ID of the digital twin
+    :return bool: True if the twin exists, False otherwise
+    '''
+    try:
+        adt_client.get_digital_twin(digital_twin_id=dt_id)
+    except:
+        return False
+    return True
+
+
 def insert_adt_relationship(adt_client: DigitalTwinsClient, sourceId: str, targetId: str, rel_name: str, rel_id: str = None, labels: str = None) -> None:
     '''
     Inserts a new relationship in ADT between the given source and target and with the given name.
@@ -509,43 +643,47 @@ def get_update_patches(resource: Union[Asset, TimeSeries], digital_twin: dict) -
     p = []  # list of JSON patches to use for updating the digital twin
 
     # external ID and internal ID are special cases: should not be allowed to change so set only if empty
-    if not('externalId' in digital_twin):
+    dt_ext_id = digital_twin.get('externalId')
+    if (dt_ext_id is None):
         p.append({'op': 'add', 'path': '/externalId', 'value': resource.external_id})
-    elif (digital_twin['externalId'] == ''):
+    elif (dt_ext_id == ''):
         p.append({'op': 'replace', 'path': '/externalId', 'value': resource.external_id})
-    elif (resource.external_id != digital_twin['externalId']):
-        logging.warning('CDF external ID "%s" should match ADT external ID property "%s". Not updating!', resource.external_id, digital_twin['externalId'])
-    if not('id' in digital_twin):
-        p.append({'op': 'add', 'path': '/id', 'value': str(resource.id)})
-    elif (digital_twin['id'] == ''):
-        p.append({'op': 'replace', 'path': '/id', 'value': str(resource.id)})
-    elif (str(resource.id) != digital_twin['id']):
-        logging.warning('CDF internal ID "%s" should match ADT "id" property "%s". Not updating!', str(resource.id), digital_twin['id'])
+    elif (resource.external_id != dt_ext_id):
+        logging.warning('CDF external ID "%s" should match ADT external ID property "%s". Not updating!', resource.external_id, dt_ext_id)
+    res_id = str(resource.id)
+    dt_id = digital_twin.get('id')
+    if (dt_id is None):
+        p.append({'op': 'add', 'path': '/id', 'value': res_id})
+    elif (dt_id == ''):
+        p.append({'op': 'replace', 'path': '/id', 'value': res_id})
+    elif (res_id != dt_id):
+        logging.warning('CDF internal ID "%s" should match ADT "id" property "%s". Not updating!', res_id, dt_id)
 
     # name and description are simple cases
-    if not('displayName' in digital_twin):
+    dt_name = digital_twin.get('displayName')
+    if (dt_name is None):
         p.append({'op': 'add', 'path': '/displayName', 'value': resource.name})
-    elif (resource.name != digital_twin['displayName']):
+    elif (resource.name != dt_name):
         p.append({'op': 'replace', 'path': '/displayName', 'value': resource.name})
+    dt_description = digital_twin.get('description')
     if not(resource.description):  # description may not exist yet/anymore
-        if ('description' in digital_twin):
+        if (dt_description is not None):
             p.append({'op': 'remove', 'path': '/description'})
-    elif not('description' in digital_twin):
+    elif (dt_description is None):
         p.append({'op': 'add', 'path': '/description', 'value': resource.description})
-    elif (resource.description != digital_twin['description']):
+    elif (resource.description != dt_description):
         p.append({'op': 'replace', 'path': '/description', 'value': resource.description})
     
     # CDF metadata is a dictionary itself, and the 'tags' is a map in ADT
-    if (not('values' in digital_twin['tags'])):
-        digital_twin['tags']['values'] = {}   # create the tags if it does not exist
+    tag_values = digital_twin['tags'].setdefault('values', {})   # create the tags if it does not exist
     meta = convert_metadata(resource.metadata)
-    if (meta != digital_twin['tags']['values']):
-        for k in meta:
-            if not(k in digital_twin['tags']['values']):
-                p.append({'op': 'add', 'path': '/tags/values/' + k, 'value': meta[k]})                    
-            elif (meta[k] != digital_twin['tags']['values'][k]):
-                p.append({'op': 'replace', 'path': '/tags/values/' + k, 'value': meta[k]})
-        for k in digital_twin['tags']['values']:
+    if (meta != tag_values):
+        for (k, v) in meta.items():
+            if not(k in tag_values):
+                p.append({'op': 'add', 'path': '/tags/values/' + k, 'value': v})
+            elif (v != tag_values[k]):
+                p.append({'op': 'replace', 'path': '/tags/values/' + k, 'value': v})
+        for k in tag_values:
             if not(k in meta):
                 p.append({'op': 'remove', 'path': '/tags/values/' + k})
     return p    
@@ -562,26 +700,57 @@ def query_adt_batches(adt_client: DigitalTwinsClient, sql_template: str, predica
     res_adt = []
     n = SQL_IN_BATCH_SIZE
     for pred_batch in [predicates[i:i+n] for i in range(0, len(predicates), n)]:
-        sql_query = sql_template.replace(SQL_PLACEHOLDER, str(pred_batch))
-        res_adt_batch = adt_client.query_twins(sql_query)
-        res_adt.extend(list(res_adt_batch))
+        sql_query = sql_template.replace(SQL_PLACEHOLDER, make_in_list(pred_batch))
+        res_adt.extend(adt_client.query_twins(sql_query))
     return res_adt
 
 
+def make_in_list(predicates: list[str]) -> str:
+    '''
+    Builds the list of an ADT SQL IN/NIN operation, e.g. ['id1','id2'], with each value escaped.
+    :param list[str] predicates: the values of the list
+    :return str: the list to be inserted into the SQL query
+    '''
+    return '[' + ','.join('\'' + escape_query_value(p) + '\'' for p in predicates) + ']'
+
+
+def escape_query_value(value: str) -> str:
+    '''
+    Escapes a value to be used inside a single-quoted string literal of an ADT query.
+    :param str value: the value to escape
+    :return str: the escaped value
+    '''
+    return value.replace('\\', '\\\\').replace('\'', '\\\'')
+
+
+# replaces the characters of CDF external IDs that are problematic in ADT, in a single pass over the ID
+EXT_ID_TRANSLATION = str.maketrans({':': '*', ' ': '_', '&': 'AND'})
+
+
+@lru_cache(maxsize=65536)
 def convert_ext_id(external_id: str) -> str:
     '''
     Converts CDF external ID to valid ADT ID by replacing the following problematic characters:
         ':'     ->  '*'
         <space> ->  '_'
+        '&'     ->  'AND'
     WARNING: this is a temporary solution
         (not sure if this should be handled at all, could just thow error for the whole conversion)
+    The same IDs are converted many times during a synchronization, so the results are memoized.
     '''
     if (external_id):
-        return external_id.replace(':', '*').replace(' ', '_').replace('&','AND')
+        return external_id.translate(EXT_ID_TRANSLATION)
     else:
         return external_id
 
 
+# replaces the characters of CDF metadata keys that are problematic in ADT, in a single pass over the key
+METADATA_KEY_TRANSLATION = str.maketrans({' ': '_', '.': '^', '$': '#'})
+# the same table for ASCII keys (the typical case), which bytes.translate handles several times faster than str.translate
+METADATA_KEY_TRANSLATION_ASCII = bytes.maketrans(bytes(METADATA_KEY_TRANSLATION), ''.join(METADATA_KEY_TRANSLATION.values()).encode())
+METADATA_KEY_SPECIAL_CHARS = re.compile('[' + re.escape(''.join(map(chr, METADATA_KEY_TRANSLATION))) + ']')   # matches keys needing translation
+
+
 def convert_metadata(metadata: dict) -> dict:
     '''
     Converts CDF metadata to valid ADT format, replacing problematic characters in map keys:
@@ -589,39 +758,36 @@ def convert_metadata(metadata: dict) -> dict:
         '.'     ->  '^'
         '$'     ->  '#'
     WARNING: temporary solution
+    The metadata is returned as is (not copied) if none of its keys contains these characters.
     '''
-    new_map = {}
-    for k in metadata:
-        kk = k.replace(' ', '_').replace('.', '^').replace('$', '#')
-        new_map[kk] = metadata[k]
-    return new_map
+    if not(any(METADATA_KEY_SPECIAL_CHARS.search(k) for k in metadata)):
+        return metadata
+    return {(k.encode().translate(METADATA_KEY_TRANSLATION_ASCII).decode() if (k.isascii()) else k.translate(METADATA_KEY_TRANSLATION)): v
+        for (k, v) in metadata.items()}
 
 
-def get_last_exec_file() -> Tuple[BlobClient, dict]:
+def get_last_exec_file() -> dict:
     '''
-    Retrieves the contents of the file stored in the Azure blob storage, describing information 
+    Retrieves the contents of the legacy file stored in the Azure blob storage, describing information 
     about the last time the CDF->ADT synchronization was executed: timestamp in seconds for each root asset.
+    It is only read for root assets that have no blob of their own yet (i.e. were last synchronized by an older version).
     '''
-    try:
-        connect_str = os.getenv('AzureWebJobsStorage')
-        blob_service_client = BlobServiceClient.from_connection_string(connect_str)
-    except:
-        logging.error('ERROR: Cannot connect to Azure Blob Storage!')
-        raise
-
-    container_client: ContainerClient
-    container_client = blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
-    if not(container_client.exists()):  # create the container now
-        container_client = blob_service_client.create_container(BLOB_CONTAINER_NAME)
-    blob_client: BlobClient = container_client.get_blob_client(BLOB_FILE_NAME)
-
+    blob_client = _get_or_create_blob_container_client().get_blob_client(BLOB_FILE_NAME)
     try:
         stream: StorageStreamDownloader = blob_client.download_blob()
-        func_runs = json.loads(stream.readall())
-        return (blob_client, func_runs)
+        return json.loads(stream.readall())
     except ResourceNotFoundError:
         # start with empty result, i.e. this is the first time the function is executed
-        return (blob_client, {'last_executions': []})
+        return {'last_executions': []}
+
+
+def get_last_exec_blob_client(ext_id: str) -> BlobClient:
+    '''
+    Retrieves the client of the blob holding the timestamp of the last synchronization for the given root asset.
+    :param string ext_id: external ID of the root asset
+    :return BlobClient: the blob client object
+    '''
+    return _get_or_create_blob_container_client().get_blob_client(BLOB_FOLDER_NAME + '/' + ext_id + '.json')
 
 
 def get_last_exec_TS(ext_id: str) -> float:
@@ -630,8 +796,12 @@ def get_last_exec_TS(ext_id: str) -> float:
     :param string ext_id: external ID of the root asset
     :return float: timestamp of last execution
     '''
-    (_, func_runs) = get_last_exec_file()
-    for x in func_runs['last_executions']:
+    try:
+        stream: StorageStreamDownloader = get_last_exec_blob_client(ext_id).download_blob()
+        return json.loads(stream.readall())['timestamp_UTC']
+    except ResourceNotFoundError:
+        pass
+    for x in get_last_exec_file()['last_executions']:
         if (x['root_asset_ext_id'] == ext_id):
             return x['timestamp_UTC']
     return None
@@ -640,21 +810,75 @@ def get_last_exec_TS(ext_id: str) -> float:
 def set_last_exec_TS(ext_id: str, ts: float) -> None:
     '''
     Set the timestamp of the current execution of the CDF->ADT sync for the given asset external ID.
+    Each root asset has its own blob, so it is overwritten without reading it first (and without touching other root assets).
     :param string ext_id: external ID of the root asset
     :param float ts: timestamp of current execution
     '''
-    (blob_client, func_runs) = get_last_exec_file()
-    found = False
-    for x in func_runs['last_executions']:
-        if (x['root_asset_ext_id'] == ext_id):
-            x['timestamp_UTC'] = ts
-            found = True
-    if not(found):
-        func_runs['last_executions'].append({'root_asset_ext_id': ext_id, 'timestamp_UTC': ts})
-    blob_client.upload_blob(json.dumps(func_runs, indent=4), overwrite=True)
+    func_run = {'root_asset_ext_id': ext_id, 'timestamp_UTC': ts}
+    blob_client = get_last_exec_blob_client(ext_id)
+    data = json.dumps(func_run, separators=(',', ':'))
+    try:
+        blob_client.upload_blob(data, overwrite=True)
+    except ResourceNotFoundError:
+        # the container does not exist yet (i.e. this is the first time the function is executed): create it and retry
+        try:
+            _get_or_create_blob_container_client().create_container()
+        except ResourceExistsError:
+            pass    # created in the meantime by a concurrent execution
+        blob_client.upload_blob(data, overwrite=True)
     return
 
 
+def get_blob_container_client() -> ContainerClient:
+    '''
+    Retrieves the client of the container in the Azure blob storage holding the last synchronization timestamps.
+    The container is not checked here: reads treat a missing container like a missing blob, and it is created on the first write.
+    Prerequisite: make sure the 'AzureWebJobsStorage' environment variable is set.
+    :return: the container client object
+    '''
+    try:
+        connect_str = os.getenv('AzureWebJobsStorage')
+        blob_service_client = BlobServiceClient.from_connection_string(connect_str)
+    except:
+        logging.error('ERROR: Cannot connect to Azure Blob Storage!')
+        raise
+
+    return blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
+
+
+def _get_or_create_cdf_client() -> CogniteClient:
+    '''
+    Returns the CDF client of the worker process, creating it on first use.
+    '''
+    global _CDF_CLIENT
+    with _CLIENT_LOCK:
+        if (_CDF_CLIENT is None):
+            _CDF_CLIENT = get_cdf_client()
+    return _CDF_CLIENT
+
+
+def _get_or_create_adt_client() -> DigitalTwinsClient:
+    '''
+    Returns the ADT client of the worker process, creating it on first use.
+    '''
+    global _ADT_CLIENT
+    with _CLIENT_LOCK:
+        if (_ADT_CLIENT is None):
+            _ADT_CLIENT = get_adt_client()
+    return _ADT_CLIENT
+
+
+def _get_or_create_blob_container_client() -> ContainerClient:
+    '''
+    Returns the blob container client of the worker process, creating it on first use.
+    '''
+    global _BLOB_CONTAINER_CLIENT
+    with _CLIENT_LOCK:
+        if (_BLOB_CONTAINER_CLIENT is None):
+            _BLOB_CONTAINER_CLIENT = get_blob_container_client()
+    return _BLOB_CONTAINER_CLIENT
+
+
 def get_cdf_client() -> CogniteClient:
     '''
     Retrieves a Cognite Data Fusion (CDF) client object, which allows to interact with CDF.
@@ -679,6 +903,10 @@ def get_cdf_client() -> CogniteClient:
 
     BASE_URL = f"https://{CDF_CLUSTER}.cognitedata.com"
 
+    # the SDK sizes its connection pool when the first client is created (i.e. right below), with 50 connections by default:
+    # this only makes a difference if MAX_WORKERS is configured above 50
+    global_config.max_connection_pool_size = max(global_config.max_connection_pool_size, MAX_WORKERS)
+
     creds = OAuthClientCredentials(token_url=TOKEN_URL, client_id=CLIENT_ID, scopes=SCOPES, client_secret=CLIENT_SECRET)
     cnf = ClientConfig(client_name="cdf-optimisation", project=COGNITE_PROJECT, credentials=creds, base_url=BASE_URL)
     cdf_client = CogniteClient(cnf)
@@ -700,5 +928,8 @@ def get_adt_client() -> DigitalTwinsClient:
     '''
     url = os.environ['ADT_URL']
     credential = DefaultAzureCredential()
-    adt_client = DigitalTwinsClient(url, credential)
+    # the default pool keeps 10 connections only, keep one for each concurrent call instead
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_maxsize=MAX_WORKERS))
+    adt_client = DigitalTwinsClient(url, credential, transport=RequestsTransport(session=session))
     return adt_client